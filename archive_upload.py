@@ -1,26 +1,414 @@
 import os
-import glob
 import time
-from internetarchive import upload, delete
+import base64
+import argparse
+import threading
+import urllib.parse
+import concurrent.futures
+import requests
+from tqdm import tqdm
+from http_utils import backoff_delay, file_md5, get_session, parse_retry_after
+from state_db import StateDB
 
 identifier = "NoumanAliKhanQuranConciseCommentary"
 source_directory = "Quran_Audio"
 
-def upload_to_archive():
-    metadata = {
-        'collection': 'opensource_audio',
-        'mediatype': 'audio',
-        'creator': 'Nouman Ali Khan',
-        'title': 'Quran Commentary - Nouman Ali Khan',
-        'description': 'Understand the meanings of ayaat beyond the translation. Insights on words, phrases and context - for every ayah.',
-        'subject': ['Quran', 'Islam', 'Tafsir', 'Commentary', 'Nouman Ali Khan', 'Audio'],
+# --- Configuration ---
+UPLOAD_WORKERS = 8
+SYNC_STATE_PATH = os.path.join(source_directory, ".archive_sync.sqlite")
+MAX_ATTEMPTS = 5
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}  # IA answers 503 SlowDown when overloaded
+# Point these at a local stand-in to test without touching archive.org
+S3_ENDPOINT = os.environ.get("IA_S3_ENDPOINT", "https://s3.us.archive.org")
+METADATA_ENDPOINT = os.environ.get("IA_METADATA_ENDPOINT", "https://archive.org/metadata")
+TASKS_ENDPOINT = os.environ.get("IA_TASKS_ENDPOINT", "https://archive.org/services/tasks.php")
+
+METADATA = {
+    'collection': 'opensource_audio',
+    'mediatype': 'audio',
+    'creator': 'Nouman Ali Khan',
+    'title': 'Quran Commentary - Nouman Ali Khan',
+    'description': 'Understand the meanings of ayaat beyond the translation. Insights on words, phrases and context - for every ayah.',
+    'subject': ['Quran', 'Islam', 'Tafsir', 'Commentary', 'Nouman Ali Khan', 'Audio'],
+}
+
+
+def get_credentials():
+    """Returns (access, secret) from IA_ACCESS_KEY/IA_SECRET_KEY or the `ia configure` config file."""
+    access, secret = os.environ.get("IA_ACCESS_KEY"), os.environ.get("IA_SECRET_KEY")
+    if access and secret:
+        return access, secret
+    from internetarchive.config import get_config
+    s3 = get_config().get('s3', {})
+    return s3.get('access'), s3.get('secret')
+
+
+def metadata_headers(metadata):
+    """Converts item metadata to IA-S3 x-archive-meta headers; list values become meta01, meta02, ..."""
+    headers = {}
+    for key, value in metadata.items():
+        values = value if isinstance(value, list) else [value]
+        for index, item in enumerate(values, start=1):
+            name = f"x-archive-meta{index:02d}-{key}" if len(values) > 1 else f"x-archive-meta-{key}"
+            headers[name] = f"uri({urllib.parse.quote(str(item))})"
+    return headers
+
+
+def remote_name(path, directory=source_directory):
+    """Returns the item file name for a local path, relative to the parent of `directory`."""
+    parent = os.path.dirname(os.path.abspath(directory))
+    return os.path.relpath(os.path.abspath(path), parent).replace(os.sep, '/')
+
+
+def should_publish(filename):
+    """False for dotfiles (e.g. the download manifest) and unfinished '.part' downloads."""
+    return not filename.startswith('.') and not filename.endswith('.part')
+
+
+def list_local_files(directory=source_directory):
+    """
+    Returns {remote name: local path} for every file under `directory`. Names
+    keep the directory prefix, matching what internetarchive.upload used.
+    """
+    files = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if not should_publish(filename):
+                continue
+            path = os.path.join(root, filename)
+            files[remote_name(path, directory)] = path
+    return files
+
+
+def fetch_remote_md5s(identifier=identifier):
+    """Returns {name: md5} for the files already in the item, or {} if it doesn't exist yet."""
+    response = get_session().get(f"{METADATA_ENDPOINT}/{identifier}/files", timeout=60)
+    response.raise_for_status()
+    return {f['name']: f.get('md5') for f in response.json().get('result', [])}
+
+
+_listing_lock = threading.Lock()  # Held while the item's file list is fetched into the state
+_create_lock = threading.Lock()  # Held around the PUT that creates the item
+
+
+class SyncState(StateDB):
+    """
+    What has been published: each file's remote name, size, mtime, MD5 and
+    upload status. Planning a sync is a stat per local file plus
+    index lookups, with no request to archive.org. The item's file list is
+    fetched once, when the state is first used, and kept in `remote_files` so
+    files published some other way can be adopted later without asking again.
+    Each thread that writes to it, such as a pipeline upload worker, opens its
+    own connection.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS files (
+               name TEXT PRIMARY KEY,
+               size INTEGER NOT NULL,
+               mtime_ns INTEGER NOT NULL,
+               md5 TEXT NOT NULL,
+               status TEXT NOT NULL,
+               updated_at REAL NOT NULL
+           )""",
+        "CREATE TABLE IF NOT EXISTS remote_files (name TEXT PRIMARY KEY, md5 TEXT)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    )
+
+    def __init__(self, path=SYNC_STATE_PATH):
+        super().__init__(path)
+
+    def has_uploads(self):
+        return self.conn.execute("SELECT 1 FROM files WHERE status = 'uploaded' LIMIT 1").fetchone() is not None
+
+    def has_remote_listing(self):
+        return self.conn.execute("SELECT 1 FROM meta WHERE key = 'remote_listed_at'").fetchone() is not None
+
+    def item_exists(self):
+        """True if a file was uploaded, or the stored listing shows the item already had files."""
+        return self.has_uploads() or self.conn.execute("SELECT 1 FROM remote_files LIMIT 1").fetchone() is not None
+
+    def store_remote_listing(self, md5s):
+        self.conn.executemany("INSERT OR REPLACE INTO remote_files VALUES (?, ?)", md5s.items())
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('remote_listed_at', ?)", (str(time.time()),))
+        self.commit()
+
+    def remote_md5s(self, names):
+        """Returns {name: md5} for those of `names` the stored listing has."""
+        found = {}
+        for name in names:
+            row = self.conn.execute("SELECT md5 FROM remote_files WHERE name = ?", (name,)).fetchone()
+            if row:
+                found[name] = row[0]
+        return found
+
+    def entries(self):
+        """Returns {name: row dict} for every recorded file."""
+        cursor = self.conn.execute("SELECT name, size, mtime_ns, md5, status FROM files")
+        columns = [column[0] for column in cursor.description]
+        return {row[0]: dict(zip(columns, row)) for row in cursor}
+
+    def record(self, name, path, md5, status):
+        stat = os.stat(path)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (name, stat.st_size, stat.st_mtime_ns, md5, status, time.time()),
+        )
+
+    def remove(self, name):
+        self.conn.execute("DELETE FROM files WHERE name = ?", (name,))
+
+
+def plan_sync(local_files, state, workers=UPLOAD_WORKERS, directory=source_directory, dry_run=False):
+    """
+    Diffs the local tree under `directory` against the sync state. Files whose
+    size and mtime match an uploaded row are skipped without being read; only
+    the rest are hashed, and a file that was merely touched is re-recorded
+    rather than sent. Only rows under `directory` can be reported as deleted:
+    the state also holds files published from elsewhere, e.g. the pipeline's
+    concatenated surahs. With `dry_run`, nothing is written to the state.
+    Returns (new, changed, deleted, md5s).
+    """
+    known = state.entries()
+    candidates = []
+    for name, path in local_files.items():
+        row = known.get(name)
+        stat = os.stat(path)
+        if not (row and row['status'] == 'uploaded' and row['size'] == stat.st_size and row['mtime_ns'] == stat.st_mtime_ns):
+            candidates.append(name)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        md5s = dict(zip(candidates, executor.map(file_md5, (local_files[name] for name in candidates))))
+
+    new, changed = [], []
+    for name in candidates:
+        row = known.get(name)
+        if row and row['status'] == 'uploaded' and row['md5'] == md5s[name]:
+            if not dry_run:
+                state.record(name, local_files[name], md5s[name], 'uploaded')  # Touched, not modified
+        elif row and row['status'] == 'uploaded':
+            changed.append(name)
+        else:
+            new.append(name)
+    state.commit()
+    prefix = remote_name(directory, directory) + "/"
+    deleted = sorted(name for name, row in known.items()
+                     if name.startswith(prefix) and name not in local_files and row['status'] == 'uploaded')
+    return sorted(new), sorted(changed), deleted, md5s
+
+
+def adopt_remote_files(local_files, state, workers=UPLOAD_WORKERS, dry_run=False):
+    """
+    Finds the local files with no sync state row that the item already holds
+    with the same MD5, so files published some other way (e.g. by an earlier
+    internetarchive.upload run) aren't sent again, and records them as
+    uploaded unless `dry_run`. The item's file list is fetched only the first
+    time the state is used; after that this is index lookups. Returns the
+    adopted names.
+    """
+    known = state.entries()
+    unknown = [name for name in local_files if name not in known]
+    if not unknown:
+        return []
+    with _listing_lock:
+        if state.has_remote_listing():
+            remote_md5s = state.remote_md5s(unknown)
+        else:
+            listing = fetch_remote_md5s()
+            if not dry_run:
+                state.store_remote_listing(listing)
+            remote_md5s = {name: listing[name] for name in unknown if name in listing}
+    names = list(remote_md5s)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        md5s = dict(zip(names, executor.map(file_md5, (local_files[name] for name in names))))
+    adopted = [name for name in names if md5s[name] == remote_md5s[name]]
+    if not dry_run:
+        # Hash first, then write: another connection may be waiting on the write lock
+        for name in adopted:
+            state.record(name, local_files[name], md5s[name], 'uploaded')
+        state.commit()
+    return adopted
+
+
+def upload_file(key, path, md5, auth, extra_headers=None):
+    """
+    PUTs one file to the item with up to MAX_ATTEMPTS attempts. Content-MD5
+    lets the server reject a corrupted transfer. No derive is queued for the
+    file; see queue_derive. Returns None on success or an error message.
+    """
+    url = f"{S3_ENDPOINT}/{identifier}/{urllib.parse.quote(key)}"
+    headers = {
+        'authorization': f"LOW {auth[0]}:{auth[1]}",
+        'x-archive-auto-make-bucket': '1',
+        'x-archive-queue-derive': '0',
+        'Content-MD5': base64.b64encode(bytes.fromhex(md5)).decode(),
+        **(extra_headers or {}),
     }
-    print(f"\nStarting bulk upload to https://archive.org/details/{identifier}")
+    error = None
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        retry_after = None
+        try:
+            with open(path, 'rb') as body:
+                response = get_session().put(url, data=body, headers={**headers, 'Content-Length': str(os.path.getsize(path))}, timeout=300)
+            if response.ok:
+                return None
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return error
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+        if attempt < MAX_ATTEMPTS:
+            time.sleep(backoff_delay(attempt, retry_after))
+    return error
+
+
+def delete_file(key, auth):
+    """Deletes one file from the item. Returns None on success or an error message."""
+    url = f"{S3_ENDPOINT}/{identifier}/{urllib.parse.quote(key)}"
     try:
-        upload(identifier, source_directory, metadata=metadata, verbose=True)
-        # delete(identifier, verbose=True)
-    except Exception as e:
-        print(f"\n✗ AN ERROR OCCURRED: {e}")
+        response = get_session().delete(url, headers={'authorization': f"LOW {auth[0]}:{auth[1]}", 'x-archive-cascade-delete': '1'}, timeout=60)
+    except requests.exceptions.RequestException as e:
+        return str(e)
+    return None if response.ok or response.status_code == 404 else f"HTTP {response.status_code}: {response.text[:200]}"
+
+
+def queue_derive(auth):
+    """
+    Queues one derive task for the whole item, so its derivative formats are
+    rebuilt once per sync rather than after every PUT. Returns None on success
+    or an error message.
+    """
+    try:
+        response = get_session().post(TASKS_ENDPOINT, json={'identifier': identifier, 'cmd': 'derive.php'},
+                                      headers={'authorization': f"LOW {auth[0]}:{auth[1]}"}, timeout=60)
+    except requests.exceptions.RequestException as e:
+        return str(e)
+    return None if response.ok else f"HTTP {response.status_code}: {response.text[:200]}"
+
+
+_derive_deferred = threading.Event()  # Set when a sync uploaded files and left the derive to its caller
+
+
+def queue_deferred_derive():
+    """Queues the derive that upload_paths(..., derive=False) calls skipped, if any of them uploaded files."""
+    if not _derive_deferred.is_set():
+        return
+    _derive_deferred.clear()
+    error = queue_derive(get_credentials())
+    if error:
+        print(f"✗ Could not queue a derive for the item: {error}")
+
+
+def upload_to_archive(workers=UPLOAD_WORKERS, dry_run=False, delete=False):
+    """
+    Uploads the files under `source_directory` that are new or changed since
+    the last sync, `workers` at a time. With `dry_run`, only prints the plan.
+    Files deleted locally are reported, and removed from the item only with `delete`.
+    """
+    print(f"\nSyncing '{source_directory}' to https://archive.org/details/{identifier}")
+    local_files = list_local_files()
+    with SyncState() as state:
+        adopted = adopt_remote_files(local_files, state, workers, dry_run)
+        if adopted:
+            print(f"{len(adopted)} files were already in the item; {'would record' if dry_run else 'recorded'} "
+                  f"them without uploading.")
+        new, changed, deleted, md5s = plan_sync(local_files, state, workers, dry_run=dry_run)
+        if dry_run:
+            adopted = set(adopted)
+            new = [name for name in new if name not in adopted]
+        to_upload = new + changed
+        transfer = sum(os.path.getsize(local_files[key]) for key in to_upload)
+        print(f"{len(new)} new, {len(changed)} changed, {len(deleted)} deleted locally; "
+              f"{len(local_files) - len(to_upload)} up to date. {transfer / 1e6:.1f} MB to upload.")
+        if dry_run:
+            for label, names in (("+", new), ("~", changed), ("-", deleted)):
+                for name in names:
+                    print(f"  {label} {name}")
+            if deleted and not delete:
+                print("Deleted files are kept in the item unless --delete is given.")
+            return True
+        if not to_upload and not (deleted and delete):
+            return True
+        return _sync(state, local_files, to_upload, deleted if delete else [], md5s, workers)
+
+
+def upload_paths(paths, workers=UPLOAD_WORKERS, derive=True):
+    """
+    Uploads just `paths` if they are new or changed, e.g. one surah at a time
+    from the pipeline runner. Deletions aren't considered. With derive=False,
+    the item's derive is left for queue_deferred_derive, so a run of many
+    calls queues only one. Returns True when every file is published.
+    """
+    local_files = {remote_name(path): path for path in paths}
+    with SyncState() as state:
+        adopt_remote_files(local_files, state, workers)
+        new, changed, _, md5s = plan_sync(local_files, state, workers)
+        return not (new or changed) or _sync(state, local_files, new + changed, [], md5s, workers, derive)
+
+
+def _sync(state, local_files, to_upload, to_delete, md5s, workers, derive=True):
+    """
+    Applies a sync plan, recording each file's outcome in `state` as it
+    finishes. If any file was uploaded, one derive is queued for the item at
+    the end, or deferred to queue_deferred_derive when `derive` is False.
+    """
+    auth = get_credentials()
+    failed = {}
+    uploaded = 0
+    if to_upload:
+        # The first PUT creates the item and sets its metadata; the rest can then go in parallel.
+        # Concurrent callers wait here, then see the item as created.
+        with _create_lock:
+            if not state.item_exists():
+                first = to_upload.pop(0)
+                error = upload_file(first, local_files[first], md5s[first], auth, metadata_headers(METADATA))
+                state.record(first, local_files[first], md5s[first], 'failed' if error else 'uploaded')
+                state.commit()
+                if error:
+                    print(f"\n✗ Could not create the item with '{first}': {error}")
+                    return False
+                uploaded += 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(upload_file, key, local_files[key], md5s[key], auth): key for key in to_upload}
+        with tqdm(total=len(futures), desc="Uploading", unit="file") as pbar:
+            for future in concurrent.futures.as_completed(futures):
+                key, error = futures[future], future.result()
+                state.record(key, local_files[key], md5s[key], 'failed' if error else 'uploaded')
+                state.commit()  # Per file, so a concurrent pipeline worker never waits long on the write lock
+                if error:
+                    failed[key] = error
+                else:
+                    uploaded += 1
+                pbar.update(1)
+
+        for key, error in zip(to_delete, executor.map(lambda key: delete_file(key, auth), to_delete)):
+            if error:
+                failed[key] = error
+            else:
+                state.remove(key)
+        state.commit()
+
+    if uploaded and derive:
+        error = queue_derive(auth)
+        if error:
+            print(f"\n✗ Could not queue a derive for the item: {error}")
+    elif uploaded:
+        _derive_deferred.set()
+
+    if failed:
+        print(f"\n✗ {len(failed)} files failed to sync; rerun to retry them:")
+        for key, error in sorted(failed.items()):
+            print(f"  - {key}: {error}")
+        return False
+    print("\n✓ Upload complete.")
+    return True
 
 if __name__ == "__main__":
-    upload_to_archive()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Upload new or changed files to archive.org.")
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS, help="Parallel uploads.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the planned changes and transfer size without uploading.")
+    parser.add_argument("--delete", action="store_true", help="Also delete files from the item that were removed locally.")
+    args = parser.parse_args()
+    upload_to_archive(args.workers, args.dry_run, args.delete)
@@ -1,46 +1,349 @@
 import os
+import json
+import wave
+import struct
+import argparse
 import subprocess
+import concurrent.futures
+import numpy as np
 
 # --- Configuration ---
 INPUT_FOLDER = "output_audio"
 OUTPUT_FILENAME = "concatenated_ffmpeg.wav"
 TEMP_LIST_FILENAME = "ffmpeg_file_list.txt"
+COPY_BUFFER_SIZE = 1024 * 1024  # Used only when the kernel copy calls are unavailable
+
+# Per-group mode: one output per subdirectory (e.g. Surah_001/ or audio/<sura>/)
+GROUPED_OUTPUT_DIR = "concatenated"
+INDEX_FILENAME = "index.json"
+COMBINED_FILENAME = "combined.wav"
+FFMETADATA_FILENAME = "combined.ffmetadata"
+GROUP_WORKERS = os.cpu_count() or 1
+
+# Optional preprocessing (--normalize): level-match clips and even out the gaps between them
+NORMALIZED_FOLDER = "normalized_audio"
+ANALYSIS_CACHE_FILENAME = ".analysis_cache.json"
+TARGET_LOUDNESS_DBFS = -20.0  # Mean level of the non-silent frames
+MAX_GAIN_DB = 20.0  # Never boost near-silent clips by more than this
+SILENCE_THRESHOLD_DBFS = -50.0
+SILENCE_FRAME_MS = 10
+TARGET_GAP_MS = 400  # Silence between consecutive clips; half is placed on each side
+NORMALIZE_WORKERS = os.cpu_count() or 1
 # ---------------------
 
-def concatenate_audio_with_ffmpeg():
+RIFF_MAX_SIZE = 0xFFFFFFFF  # Largest size a 32-bit RIFF header can describe
+
+
+class WavFormatError(Exception):
+    """Raised when inputs can't be joined by a plain header rewrite."""
+
+
+def read_wav_layout(path):
+    """
+    Parses the chunk list of a RIFF or RF64 WAV file without reading the audio.
+    Returns (fmt_chunk_bytes, data_offset, data_size).
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[8:12] != b'WAVE' or header[:4] not in (b'RIFF', b'RF64'):
+            raise WavFormatError(f"'{path}' is not a RIFF/RF64 WAVE file")
+
+        fmt_chunk = None
+        ds64_data_size = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise WavFormatError(f"'{path}' has no data chunk")
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'ds64':
+                ds64 = f.read(chunk_size)
+                ds64_data_size = struct.unpack('<Q', ds64[8:16])[0]
+            elif chunk_id == b'fmt ':
+                fmt_chunk = f.read(chunk_size)
+            elif chunk_id == b'data':
+                if fmt_chunk is None:
+                    raise WavFormatError(f"'{path}' has its data chunk before the fmt chunk")
+                data_offset = f.tell()
+                if chunk_size == RIFF_MAX_SIZE and ds64_data_size is not None:
+                    chunk_size = ds64_data_size
+                # Writers that stream to a pipe leave a placeholder size; trust the file length.
+                data_size = min(chunk_size, file_size - data_offset)
+                return fmt_chunk, data_offset, data_size
+            else:
+                f.seek(chunk_size, os.SEEK_CUR)
+            if chunk_size % 2:
+                f.seek(1, os.SEEK_CUR)  # Chunks are word-aligned
+
+
+def build_wav_header(fmt_chunk, data_size):
+    """
+    Builds the header for a WAV file holding `data_size` bytes of audio.
+    Switches to RF64 (with a ds64 chunk) when the sizes overflow 32 bits.
+    """
+    fmt_part = struct.pack('<4sI', b'fmt ', len(fmt_chunk)) + fmt_chunk
+    if len(fmt_chunk) % 2:
+        fmt_part += b'\0'
+    padding = data_size % 2
+    riff_size = 4 + len(fmt_part) + 8 + data_size + padding
+
+    if riff_size + 36 <= RIFF_MAX_SIZE:
+        return (struct.pack('<4sI4s', b'RIFF', riff_size, b'WAVE') + fmt_part
+                + struct.pack('<4sI', b'data', data_size))
+
+    block_align = struct.unpack('<H', fmt_chunk[12:14])[0]
+    riff_size += 36  # The ds64 chunk
+    ds64 = struct.pack('<4sIQQQI', b'ds64', 28, riff_size, data_size, data_size // block_align, 0)
+    return (struct.pack('<4sI4s', b'RF64', RIFF_MAX_SIZE, b'WAVE') + ds64 + fmt_part
+            + struct.pack('<4sI', b'data', RIFF_MAX_SIZE))
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    """
+    Appends `count` bytes from `src_fd` at `offset` to `dst_fd`, preferring
+    in-kernel copies (copy_file_range, then sendfile) over a userspace loop.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    while count > 0:
+        copied = 0
+        if copy_file_range is not None:
+            try:
+                copied = copy_file_range(src_fd, dst_fd, count, offset)
+            except OSError:
+                copy_file_range = None  # E.g. unsupported filesystem; fall through
+        if not copied and hasattr(os, 'sendfile'):
+            try:
+                copied = os.sendfile(dst_fd, src_fd, offset, count)
+            except OSError:
+                copied = 0
+        if not copied:
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            buffer = os.read(src_fd, min(count, COPY_BUFFER_SIZE))
+            if not buffer:
+                raise WavFormatError("Input file ended before its data chunk did")
+            copied = os.write(dst_fd, buffer)
+        offset += copied
+        count -= copied
+
+
+def concatenate_wav_native(file_paths, output_path):
+    """
+    Joins PCM WAV files by writing one header and streaming each data chunk
+    straight into the output, without decoding or spawning ffmpeg.
+    Raises WavFormatError if the inputs don't all share the same format.
+    """
+    layouts = [read_wav_layout(path) for path in file_paths]
+    fmt_chunk = layouts[0][0]
+    for path, (other_fmt, _, _) in zip(file_paths, layouts):
+        if other_fmt != fmt_chunk:
+            raise WavFormatError(f"'{path}' has a different audio format than '{file_paths[0]}'")
+
+    data_size = sum(size for _, _, size in layouts)
+    temp_output = output_path + ".part"
+    try:
+        with open(temp_output, 'wb') as out:
+            out.write(build_wav_header(fmt_chunk, data_size))
+            out.flush()
+            for path, (_, data_offset, size) in zip(file_paths, layouts):
+                with open(path, 'rb') as src:
+                    copy_range(src.fileno(), out.fileno(), data_offset, size)
+            if data_size % 2:
+                out.write(b'\0')
+        os.replace(temp_output, output_path)
+    finally:
+        # Don't leave a partial output behind if a copy failed
+        if os.path.exists(temp_output):
+            os.remove(temp_output)
+    return data_size
+
+
+def append_wav_native(output_path, recorded_data_size, file_paths):
+    """
+    Appends the data chunks of `file_paths` to an existing output whose
+    header was written by build_wav_header, then rewrites its sizes.
+    `recorded_data_size` is the data size the index recorded, so bytes left
+    by an interrupted append are discarded first. Returns the new data size,
+    or None if the output must be rebuilt instead (format change, or a
+    header that would have to grow into RF64).
+    """
+    fmt_chunk, data_offset, _ = read_wav_layout(output_path)
+    layouts = [read_wav_layout(path) for path in file_paths]
+    if any(other_fmt != fmt_chunk for other_fmt, _, _ in layouts):
+        return None
+    data_size = recorded_data_size + sum(size for _, _, size in layouts)
+    header = build_wav_header(fmt_chunk, data_size)
+    if len(header) != data_offset:
+        return None
+
+    with open(output_path, 'r+b') as out:
+        out.truncate(data_offset + recorded_data_size)  # Drops the old pad byte and any partial append
+        out.seek(0, os.SEEK_END)
+        out.flush()
+        for path, (_, src_offset, size) in zip(file_paths, layouts):
+            with open(path, 'rb') as src:
+                copy_range(src.fileno(), out.fileno(), src_offset, size)
+        out.seek(0, os.SEEK_END)
+        if data_size % 2:
+            out.write(b'\0')
+        out.seek(0)
+        out.write(header)
+    return data_size
+
+
+def read_pcm16(path):
+    """Reads a 16-bit PCM WAV file into an int16 array of shape (frames, channels)."""
+    with wave.open(path, 'rb') as wav:
+        params = wav.getparams()
+        if params.sampwidth != 2:
+            raise WavFormatError(f"'{path}' is not 16-bit PCM")
+        raw = wav.readframes(params.nframes)
+    return np.frombuffer(raw, dtype='<i2').reshape(-1, params.nchannels), params
+
+
+def analyze_samples(samples, framerate):
+    """
+    Measures a clip in SILENCE_FRAME_MS frames. Returns the sample range
+    between the first and last non-silent frame and the mean level (dBFS)
+    of the non-silent frames, or None for the level if the clip is silent.
     """
-    Finds all .wav files in the input folder, creates a list for ffmpeg,
-    and uses the 'concat' demuxer to losslessly join them.
+    frame = max(1, framerate * SILENCE_FRAME_MS // 1000)
+    mono = samples.mean(axis=1, dtype=np.float32) / 32768.0
+    frames = np.pad(mono, (0, -len(mono) % frame)).reshape(-1, frame)
+    power = np.mean(frames * frames, axis=1)
+    voiced = np.flatnonzero(power > 10 ** (SILENCE_THRESHOLD_DBFS / 10))
+    if not voiced.size:
+        return {'start': 0, 'end': 0, 'loudness': None}
+    return {
+        'start': int(voiced[0] * frame),
+        'end': int(min(len(mono), (voiced[-1] + 1) * frame)),
+        'loudness': float(10 * np.log10(power[voiced].mean())),
+    }
+
+
+def prepare_clip(path, output_path, analysis=None):
+    """
+    Writes a level-matched copy of `path` with its leading and trailing
+    silence replaced by half of TARGET_GAP_MS on each side. The gain, trim
+    and padding are applied in one vectorised pass. `analysis` is reused if
+    given, so cached clips are never measured again. Returns the analysis.
     """
+    samples, params = read_pcm16(path)
+    if analysis is None:
+        analysis = analyze_samples(samples, params.framerate)
+
+    gain = 1.0
+    if analysis['loudness'] is not None:
+        gain = 10 ** (min(TARGET_LOUDNESS_DBFS - analysis['loudness'], MAX_GAIN_DB) / 20)
+    start, end = analysis['start'], analysis['end']
+    pad = params.framerate * TARGET_GAP_MS // 2000
+
+    out = np.zeros((pad + (end - start) + pad, params.nchannels), dtype='<i2')
+    np.clip(np.rint(samples[start:end] * np.float32(gain)), -32768, 32767, out=out[pad:pad + end - start],
+            casting='unsafe')
+
+    temp_output = output_path + ".part"
+    try:
+        with wave.open(temp_output, 'wb') as wav:
+            wav.setparams(params)
+            wav.writeframes(out.tobytes())
+        os.replace(temp_output, output_path)
+    finally:
+        if os.path.exists(temp_output):
+            os.remove(temp_output)
+    return analysis
+
+
+def _render_settings():
+    return [TARGET_LOUDNESS_DBFS, MAX_GAIN_DB, TARGET_GAP_MS]
+
+
+def normalize_clips(file_paths, output_paths, workers=NORMALIZE_WORKERS, cache_path=None):
+    """
+    Runs prepare_clip over every input in a process pool. Measurements are
+    cached in `cache_path` keyed by each source's size and mtime, so later
+    runs only touch new or edited clips; outputs already rendered with the
+    current settings are left alone. Returns False if any clip failed.
+    """
+    cache_path = cache_path or os.path.join(os.path.dirname(output_paths[0]) or '.', ANALYSIS_CACHE_FILENAME)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+
+    analysis_settings = [SILENCE_THRESHOLD_DBFS, SILENCE_FRAME_MS]
+    jobs = {}
+    for path, output_path in zip(file_paths, output_paths):
+        stat = os.stat(path)
+        entry = cache.get(os.path.abspath(path))
+        if not entry or [entry['size'], entry['mtime_ns'], entry['settings']] != [stat.st_size, stat.st_mtime_ns, analysis_settings]:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'settings': analysis_settings, 'analysis': None}
+            cache[os.path.abspath(path)] = entry
+        elif entry.get('rendered') == _render_settings() and os.path.exists(output_path):
+            continue
+        jobs[path] = (output_path, entry)
+
+    if not jobs:
+        return True
+    print(f"Normalising {len(jobs)} of {len(file_paths)} clips with {workers} workers...")
+    ok = True
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(prepare_clip, path, output_path, entry['analysis']): path
+            for path, (output_path, entry) in jobs.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            entry = jobs[path][1]
+            try:
+                entry['analysis'] = future.result()
+                entry['rendered'] = _render_settings()
+            except (WavFormatError, wave.Error, OSError) as e:
+                print(f"✗ Could not normalise '{path}': {e}")
+                ok = False
+
+    temp_cache = cache_path + ".part"
+    with open(temp_cache, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(temp_cache, cache_path)
+    return ok
+
+
+def find_input_files(folder=INPUT_FOLDER):
+    """Returns the sorted paths of the .wav files in `folder`, or None if there are none."""
     # Check if the input folder exists
-    if not os.path.isdir(INPUT_FOLDER):
-        print(f"Error: Input folder '{INPUT_FOLDER}' not found.")
-        return
+    if not os.path.isdir(folder):
+        print(f"Error: Input folder '{folder}' not found.")
+        return None
 
     # Get a sorted list of absolute paths to the .wav files
     try:
         files_to_concat = sorted(
-            [f for f in os.listdir(INPUT_FOLDER) if f.endswith('.wav')]
+            [f for f in os.listdir(folder) if f.endswith('.wav')]
         )
     except FileNotFoundError:
-        print(f"Error: Could not read from folder '{INPUT_FOLDER}'.")
-        return
+        print(f"Error: Could not read from folder '{folder}'.")
+        return None
 
     if not files_to_concat:
-        print(f"No .wav files found in '{INPUT_FOLDER}'.")
-        return
+        print(f"No .wav files found in '{folder}'.")
+        return None
+    return [os.path.join(folder, f) for f in files_to_concat]
 
-    print(f"Found {len(files_to_concat)} files to concatenate:")
-    for f in files_to_concat:
-        print(f"  - {f}")
 
-    # Create the temporary list file for ffmpeg's concat demuxer
-    print(f"\nGenerating temporary file list: '{TEMP_LIST_FILENAME}'...")
-    with open(TEMP_LIST_FILENAME, 'w') as f:
-        for wav_file in files_to_concat:
+def concatenate_audio_with_ffmpeg(file_paths, output_path=OUTPUT_FILENAME):
+    """
+    Creates a list for ffmpeg and uses the 'concat' demuxer to losslessly
+    join the given files. Used as the fallback when the native engine can't
+    join the inputs with a header rewrite.
+    """
+    # Create the temporary list file for ffmpeg's concat demuxer. It is named
+    # after the output so concurrent calls (e.g. pipeline workers) don't collide.
+    list_path = f"{os.path.splitext(output_path)[0]}_{TEMP_LIST_FILENAME}"
+    print(f"\nGenerating temporary file list: '{list_path}'...")
+    with open(list_path, 'w') as f:
+        for file_path in file_paths:
             # Important: Use single quotes for ffmpeg if paths have spaces
             # The format is: file '/path/to/your/file.wav'
-            file_path = os.path.join(INPUT_FOLDER, wav_file)
             f.write(f"file '{os.path.abspath(file_path)}'\n")
 
     # Construct the ffmpeg command
@@ -50,45 +353,246 @@ def concatenate_audio_with_ffmpeg():
     # -c copy:  Copies the stream without re-encoding (fast and lossless)
     command = [
         'ffmpeg',
+        '-hide_banner',
+        '-loglevel', 'error',
         '-f', 'concat',
         '-safe', '0',
-        '-i', TEMP_LIST_FILENAME,
+        '-i', list_path,
         '-c', 'copy',
-        OUTPUT_FILENAME
+        output_path
     ]
-    
+
     # Overwrite the output file if it already exists
     command.append('-y')
 
     print("\nRunning ffmpeg command:")
     print(" ".join(command))
 
-    # Execute the command
+    # Execute the command. ffmpeg's errors go straight to the terminal
+    # instead of being buffered in memory.
     try:
-        process = subprocess.run(
-            command,
-            check=True,          # Raise an exception for non-zero exit codes
-            capture_output=True, # Capture stdout and stderr
-            text=True            # Decode stdout/stderr as text
-        )
-        print("\n--- ffmpeg output ---")
-        print(process.stderr) # ffmpeg prints progress to stderr
-        print("---------------------\n")
-        print(f"✅ Success! Audio concatenated to '{OUTPUT_FILENAME}'")
+        subprocess.run(command, check=True)
+        print(f"✅ Success! Audio concatenated to '{output_path}'")
+        return True
 
     except FileNotFoundError:
         print("\n❌ Error: 'ffmpeg' command not found.")
         print("Please make sure FFmpeg is installed and in your system's PATH.")
     except subprocess.CalledProcessError as e:
-        print("\n❌ Error during ffmpeg execution.")
-        print("--- ffmpeg error output ---")
-        print(e.stderr)
-        print("---------------------------")
+        print(f"\n❌ Error during ffmpeg execution (exit code {e.returncode}).")
     finally:
         # Clean up the temporary file list
-        if os.path.exists(TEMP_LIST_FILENAME):
-            os.remove(TEMP_LIST_FILENAME)
-            print(f"Cleaned up temporary file: '{TEMP_LIST_FILENAME}'")
+        if os.path.exists(list_path):
+            os.remove(list_path)
+            print(f"Cleaned up temporary file: '{list_path}'")
+    return False
+
+
+def concatenate_audio(folder=INPUT_FOLDER, output_path=OUTPUT_FILENAME, normalize=False,
+                      workers=NORMALIZE_WORKERS):
+    """
+    Finds all .wav files in the input folder and joins them. Uses the native
+    header-rewrite engine when every input has the same PCM format, and falls
+    back to ffmpeg otherwise. With `normalize`, the clips are first run
+    through normalize_clips and the normalised copies are joined instead.
+    """
+    file_paths = find_input_files(folder)
+    if not file_paths:
+        return False
+    if normalize:
+        os.makedirs(NORMALIZED_FOLDER, exist_ok=True)
+        normalized_paths = [os.path.join(NORMALIZED_FOLDER, os.path.basename(path)) for path in file_paths]
+        if not normalize_clips(file_paths, normalized_paths, workers):
+            return False
+        file_paths = normalized_paths
+
+    print(f"Found {len(file_paths)} files to concatenate:")
+    for path in file_paths:
+        print(f"  - {os.path.basename(path)}")
+    return concatenate_files(file_paths, output_path)
+
+
+def concatenate_files(file_paths, output_path):
+    """Joins `file_paths` natively when they are matching PCM WAVs, and with ffmpeg otherwise."""
+    try:
+        data_size = concatenate_wav_native(file_paths, output_path)
+        print(f"\n✅ Success! {data_size / 1e6:.1f} MB of audio concatenated to '{output_path}'")
+        return True
+    except WavFormatError as e:
+        print(f"\nNative concatenation not possible ({e}); falling back to ffmpeg.")
+        return concatenate_audio_with_ffmpeg(file_paths, output_path)
+
+
+def find_groups(folder=INPUT_FOLDER):
+    """Returns {subdirectory name: sorted .wav paths} for every subdirectory with audio."""
+    groups = {}
+    for entry in sorted(os.scandir(folder), key=lambda e: e.name):
+        if entry.is_dir():
+            paths = sorted(os.path.join(entry.path, f) for f in os.listdir(entry.path) if f.endswith('.wav'))
+            if paths:
+                groups[entry.name] = paths
+    return groups
+
+
+def _segment_key(segment):
+    return segment['file'], segment['size'], segment['mtime_ns']
+
+
+def concatenate_group(name, file_paths, output_path, previous=None):
+    """
+    Builds or updates one group's output and returns its index entry.
+
+    If the inputs recorded in `previous` are unchanged, nothing is written.
+    If they are an unchanged prefix of the current inputs, only the new
+    trailing files are appended. Anything else rebuilds the group.
+    """
+    segments = []
+    for path in file_paths:
+        stat = os.stat(path)
+        segments.append({'file': os.path.basename(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+    old_segments = previous['segments'] if previous and os.path.exists(output_path) else []
+    prefix = len(old_segments)
+    is_prefix = 0 < prefix <= len(segments) and all(
+        _segment_key(old) == _segment_key(new) for old, new in zip(old_segments, segments)
+    )
+
+    if is_prefix and prefix == len(segments):
+        return {**previous, 'action': 'unchanged'}
+
+    data_size = None
+    if is_prefix:
+        data_size = append_wav_native(output_path, previous['data_size'], file_paths[prefix:])
+    action = 'appended'
+    if data_size is None:
+        data_size = concatenate_wav_native(file_paths, output_path)
+        action, prefix = 'rebuilt', 0
+
+    fmt_chunk = read_wav_layout(output_path)[0]
+    byte_rate = struct.unpack('<I', fmt_chunk[8:12])[0]
+    offset = previous['segments'][prefix - 1]['offset'] + previous['segments'][prefix - 1]['data_size'] if prefix else 0
+    for segment, path in zip(segments[prefix:], file_paths[prefix:]):
+        segment['data_size'] = read_wav_layout(path)[2]
+        segment['offset'] = offset
+        segment['start'] = offset / byte_rate
+        offset += segment['data_size']
+    segments[:prefix] = old_segments[:prefix]
+
+    return {
+        'output': output_path,
+        'fmt': fmt_chunk.hex(),
+        'byte_rate': byte_rate,
+        'data_size': data_size,
+        'duration': data_size / byte_rate,
+        'segments': segments,
+        'action': action,
+    }
+
+
+def write_ffmetadata(groups, path):
+    """Writes ffmpeg chapter metadata with one chapter per group of the combined file."""
+    lines = [";FFMETADATA1"]
+    start = 0.0
+    for name, entry in groups.items():
+        end = start + entry['duration']
+        lines += ["[CHAPTER]", "TIMEBASE=1/1000", f"START={round(start * 1000)}",
+                  f"END={round(end * 1000)}", f"title={name}"]
+        start = end
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def concatenate_groups(folder=INPUT_FOLDER, output_dir=GROUPED_OUTPUT_DIR, workers=GROUP_WORKERS, normalize=False):
+    """
+    Concatenates every subdirectory of `folder` into its own file in
+    `output_dir`, in parallel, then joins the group files into one combined
+    file. Writes a JSON index of every segment's byte offset and start time,
+    plus ffmetadata chapters for the combined file. Unchanged groups are
+    skipped and groups that only gained trailing files are appended to.
+    With `normalize`, each group is joined from normalised copies kept under
+    `output_dir`/NORMALIZED_FOLDER, which are only rewritten when their
+    source changes, so incremental appends keep working.
+    """
+    if not os.path.isdir(folder):
+        print(f"Error: Input folder '{folder}' not found.")
+        return False
+    groups = find_groups(folder)
+    if not groups:
+        print(f"No subdirectories with .wav files found in '{folder}'.")
+        return False
+
+    os.makedirs(output_dir, exist_ok=True)
+    if normalize:
+        normalized_groups = {}
+        for name, paths in groups.items():
+            group_dir = os.path.join(output_dir, NORMALIZED_FOLDER, name)
+            os.makedirs(group_dir, exist_ok=True)
+            normalized_groups[name] = [os.path.join(group_dir, os.path.basename(path)) for path in paths]
+        sources = [path for paths in groups.values() for path in paths]
+        outputs = [path for paths in normalized_groups.values() for path in paths]
+        if not normalize_clips(sources, outputs, workers,
+                               os.path.join(output_dir, NORMALIZED_FOLDER, ANALYSIS_CACHE_FILENAME)):
+            return False
+        groups = normalized_groups
+
+    index_path = os.path.join(output_dir, INDEX_FILENAME)
+    previous_index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            previous_index = json.load(f).get('groups', {})
+
+    print(f"Concatenating {len(groups)} groups with {workers} workers...")
+    index = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(concatenate_group, name, paths,
+                            os.path.join(output_dir, f"{name}.wav"), previous_index.get(name)): name
+            for name, paths in groups.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                index[name] = future.result()
+            except (WavFormatError, OSError) as e:
+                print(f"✗ {name}: {e}")
+                continue
+            if index[name]['action'] != 'unchanged':
+                print(f"  - {name}: {index[name]['action']} ({len(index[name]['segments'])} segments)")
+
+    index = {name: index[name] for name in groups if name in index}
+    combined_path = os.path.join(output_dir, COMBINED_FILENAME)
+    changed = (any(entry['action'] != 'unchanged' for entry in index.values())
+               or list(index) != list(previous_index) or not os.path.exists(combined_path))
+    if changed and index:
+        try:
+            concatenate_wav_native([entry['output'] for entry in index.values()], combined_path)
+            write_ffmetadata(index, os.path.join(output_dir, FFMETADATA_FILENAME))
+        except WavFormatError as e:
+            print(f"✗ Could not build '{combined_path}': {e}")
+
+    for entry in index.values():
+        entry.pop('action', None)
+    temp_index = index_path + ".part"
+    with open(temp_index, 'w', encoding='utf-8') as f:
+        json.dump({'groups': index}, f, indent=1)
+    os.replace(temp_index, index_path)
+
+    print(f"✅ {'Updated' if changed else 'Already up to date:'} '{combined_path}' "
+          f"({sum(entry['duration'] for entry in index.values()) / 3600:.2f} h)")
+    return True
+
 
 if __name__ == "__main__":
-    concatenate_audio_with_ffmpeg()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Losslessly concatenate WAV files.")
+    parser.add_argument("--per-group", action="store_true",
+                        help="Concatenate each subdirectory separately, in parallel, with a chapter index.")
+    parser.add_argument("--workers", type=int, default=GROUP_WORKERS,
+                        help="Parallel workers for --per-group and --normalize.")
+    parser.add_argument("--normalize", action="store_true",
+                        help="Match clip loudness and even out the silence between clips before joining.")
+    args = parser.parse_args()
+
+    if args.per_group:
+        concatenate_groups(workers=args.workers, normalize=args.normalize)
+    else:
+        concatenate_audio(normalize=args.normalize, workers=args.workers)
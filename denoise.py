@@ -3,10 +3,29 @@
 file_name = "audio.mpeg"
 
 import os
+import json
+import collections
+import time
+import uuid
+import wave
 import pathlib
 import subprocess
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import modal
 
+COMFY_SERVER = "127.0.0.1:8000"
+COMFY_TIMEOUT = 1200  # Seconds a single prompt may run
+COMFY_INPUT_DIR = "/root/comfy/ComfyUI/input"
+BATCH_WORKERS = 4  # Prompts kept queued per batch so the GPU never waits on the next upload
+
+# Segmented mode for long recordings: bounded memory per prompt, crossfaded back together
+SEGMENT_SAMPLE_RATE = 44100
+SEGMENT_CHANNELS = 2
+SEGMENT_OVERLAP_SECONDS = 2.0
+SEGMENT_WORKERS = 2  # Window prompts queued at once per input
+
 def modal_download():
     # This function is executed in a Modal container to download models and create symlinks.
     from huggingface_hub import hf_hub_download
@@ -46,14 +65,146 @@ vol = modal.Volume.from_name("my-cache", create_if_missing=True)
 image = (modal.Image.debian_slim()
     .run_commands("apt update")
     .apt_install("git", "ffmpeg", "libsamplerate0-dev", "portaudio19-dev", "wget")
-    .uv_pip_install("comfy-cli", "huggingface_hub")
+    .uv_pip_install("comfy-cli", "huggingface_hub", "websockets")
     .env({"HF_HOME": "/cache"})
     .run_commands("comfy --skip-prompt install --nvidia")
     .run_commands("comfy node install tts_audio_suite && python /root/comfy/ComfyUI/custom_nodes/tts_audio_suite/install.py")
     .run_function(modal_download, volumes={"/cache": vol})
-    .add_local_file(f"/Users/firozahmed/Downloads/{file_name}", f"/root/comfy/ComfyUI/input/{file_name}")
 )
 
+def build_workflow(input_name: str, filename_prefix: str):
+    """Returns the API-format denoise workflow: MelBand RoFormer, then UVR DeEcho, saved under `filename_prefix`."""
+    return {"1":{"inputs":{"model":"MELBAND/denoise_mel_band_roformer_sdr_27.99.ckpt","use_cache":True,"aggressiveness":10,"format":"flac","audio":["2",0]},"class_type":"VocalRemovalNode","_meta":{"title":"🤐 Noise or Vocal Removal"}},"2":{"inputs":{"audio":input_name,"audioUI":""},"class_type":"LoadAudio","_meta":{"title":"LoadAudio"}},"6":{"inputs":{"model":"UVR/UVR-DeEcho-DeReverb.pth","use_cache":True,"aggressiveness":10,"format":"flac","audio":["1",1]},"class_type":"VocalRemovalNode","_meta":{"title":"🤐 Noise or Vocal Removal"}},"9":{"inputs":{"filename_prefix":filename_prefix,"audioUI":"","audio":["6",1]},"class_type":"SaveAudio","_meta":{"title":"SaveAudio"}}}
+
+def segment_bounds(num_samples: int, window: int, overlap: int):
+    """Returns [(start, end)] sample ranges of `window` samples, each overlapping the previous by `overlap`."""
+    if window <= 2 * overlap:
+        raise ValueError("Segment window must be more than twice the overlap")
+    starts = range(0, max(num_samples - overlap, 1), window - overlap)
+    return [(start, min(start + window, num_samples)) for start in starts]
+
+def overlap_add(pieces, bounds):
+    """
+    Crossfades consecutive overlapping pieces (arrays of shape (samples, channels),
+    in `bounds` order) with complementary linear ramps and yields the joined
+    output incrementally. Only one overlap is held between pieces.
+    """
+    import numpy as np
+
+    tail = None
+    for index, (piece, (start, end)) in enumerate(zip(pieces, bounds)):
+        # Models may return a few samples more or less than they were given
+        length = end - start
+        piece = np.asarray(piece, dtype=np.float32)[:length]
+        piece = np.pad(piece, ((0, length - len(piece)), (0, 0)))
+
+        if tail is not None:
+            ramp = (np.arange(1, len(tail) + 1, dtype=np.float32) / (len(tail) + 1))[:, None]
+            piece[:len(tail)] = tail + piece[:len(tail)] * ramp
+        fade_out = end - bounds[index + 1][0] if index + 1 < len(bounds) else 0
+        if fade_out:
+            ramp = (np.arange(1, fade_out + 1, dtype=np.float32) / (fade_out + 1))[:, None]
+            tail = piece[length - fade_out:] * (1 - ramp)
+            yield piece[:length - fade_out]
+        else:
+            tail = None
+            yield piece
+
+def process_segmented(num_samples: int, window: int, overlap: int, process_fn, workers: int = SEGMENT_WORKERS):
+    """
+    Runs `process_fn(index, start, end)` over overlapping windows, up to `workers`
+    at a time, and yields the overlap-added result in order. `process_fn` returns
+    the processed window as a (samples, channels) array, so passing a plain
+    slicing function exercises the whole path on CPU.
+    """
+    bounds = segment_bounds(num_samples, window, overlap)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def results():
+            # Submit lazily so finished windows can't pile up ahead of a slow one
+            pending = collections.deque()
+            for index, (start, end) in enumerate(bounds):
+                pending.append(executor.submit(process_fn, index, start, end))
+                if len(pending) > workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        yield from overlap_add(results(), bounds)
+
+def decode_to_array(audio_bytes: bytes):
+    """Decodes any audio ComfyUI saved to a float32 (samples, channels) array at the segment rate."""
+    import numpy as np
+
+    result = subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-i", "pipe:0", "-f", "f32le",
+                             "-ac", str(SEGMENT_CHANNELS), "-ar", str(SEGMENT_SAMPLE_RATE), "pipe:1"],
+                            input=audio_bytes, capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype="<f4").reshape(-1, SEGMENT_CHANNELS)
+
+class ComfyClient:
+    """
+    Minimal in-process client for a running ComfyUI server's HTTP/websocket API.
+    Each instance has its own client id, so concurrent calls only receive
+    progress for their own prompts.
+    """
+    def __init__(self, server: str = COMFY_SERVER):
+        self.server = server
+        self.client_id = uuid.uuid4().hex
+
+    def _request(self, path: str, payload=None) -> bytes:
+        data = json.dumps(payload).encode() if payload is not None else None
+        headers = {"Content-Type": "application/json"} if data else {}
+        request = urllib.request.Request(f"http://{self.server}{path}", data=data, headers=headers)
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.read()
+
+    def queue_prompt(self, workflow: dict, prompt_id: str) -> str:
+        """Queues `workflow` under `prompt_id` and returns the id the server uses for it."""
+        response = json.loads(self._request("/prompt", {"prompt": workflow, "client_id": self.client_id, "prompt_id": prompt_id}))
+        if response.get("node_errors"):
+            raise RuntimeError(f"ComfyUI rejected the workflow: {response['node_errors']}")
+        return response.get("prompt_id", prompt_id)
+
+    def wait(self, ws, prompt_id: str, timeout: float = COMFY_TIMEOUT):
+        """Blocks on the websocket until `prompt_id` finishes; raises on an execution error or timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"ComfyUI prompt {prompt_id} did not finish within {timeout}s")
+            message = ws.recv(timeout=remaining)
+            if isinstance(message, bytes):
+                continue  # Binary preview frames
+            message = json.loads(message)
+            data = message.get("data", {})
+            if data.get("prompt_id") != prompt_id:
+                continue
+            if message["type"] == "execution_error":
+                raise RuntimeError(f"ComfyUI failed on node {data.get('node_id')}: {data.get('exception_message')}")
+            if message["type"] == "execution_success" or (message["type"] == "executing" and data.get("node") is None):
+                return
+
+    def outputs(self, prompt_id: str):
+        """Returns [(filename, bytes)] for every file the prompt saved to the output directory."""
+        history = json.loads(self._request(f"/history/{prompt_id}"))[prompt_id]
+        files = []
+        for node_output in history["outputs"].values():
+            for items in node_output.values():
+                for item in items if isinstance(items, list) else []:
+                    if isinstance(item, dict) and "filename" in item and item.get("type", "output") == "output":
+                        query = urllib.parse.urlencode({"filename": item["filename"], "subfolder": item.get("subfolder", ""), "type": "output"})
+                        files.append((item["filename"], self._request(f"/view?{query}")))
+        return files
+
+    def run(self, workflow: dict, prompt_id: str = None, timeout: float = COMFY_TIMEOUT):
+        """Queues `workflow`, waits for exactly that prompt and returns its outputs."""
+        from websockets.sync.client import connect
+
+        # Connect first so no progress message for this prompt can be missed
+        with connect(f"ws://{self.server}/ws?clientId={self.client_id}", max_size=None) as ws:
+            prompt_id = self.queue_prompt(workflow, prompt_id or str(uuid.uuid4()))
+            self.wait(ws, prompt_id, timeout)
+        return self.outputs(prompt_id)
+
 app = modal.App(name="comfyapp", image=image, volumes={"/cache": vol})
 # @app.function(max_containers=1, gpu="T4")
 # @modal.concurrent(max_inputs=10)  # required for UI startup process which runs several API calls concurrently
@@ -66,28 +217,165 @@ class ComfyUI:
     @modal.enter()
     def launch_comfy_background(self):
         subprocess.run(f"comfy launch --background -- --port 8000", shell=True, check=True)
-    @modal.method()
-    def infer(self, workflow_path: str = "/root/workflow_api.json"):
-        import json
-        workflow = {"1":{"inputs":{"model":"MELBAND/denoise_mel_band_roformer_sdr_27.99.ckpt","use_cache":True,"aggressiveness":10,"format":"flac","audio":["2",0]},"class_type":"VocalRemovalNode","_meta":{"title":"🤐 Noise or Vocal Removal"}},"2":{"inputs":{"audio":file_name,"audioUI":""},"class_type":"LoadAudio","_meta":{"title":"LoadAudio"}},"6":{"inputs":{"model":"UVR/UVR-DeEcho-DeReverb.pth","use_cache":True,"aggressiveness":10,"format":"flac","audio":["1",1]},"class_type":"VocalRemovalNode","_meta":{"title":"🤐 Noise or Vocal Removal"}},"9":{"inputs":{"filename_prefix":"ComfyUI","audioUI":"","audio":["6",1]},"class_type":"SaveAudio","_meta":{"title":"SaveAudio"}}}
-        with open(workflow_path, 'w') as f:
-            json.dump(workflow, f)
-
-        subprocess.run(f"comfy run --workflow {workflow_path} --wait --timeout 1200 --verbose", shell=True, check=True)
-        output_dir = pathlib.Path("/root/comfy/ComfyUI/output")
-        
-        output_files = sorted(
-            (f for f in output_dir.iterdir() if f.is_file() and f.suffix),
-            key=lambda f: f.stat().st_mtime, reverse=True
-        )
+    def run_prompt(self, input_name: str, prompt_id: str):
+        """Runs the workflow on a file in ComfyUI's input dir and returns (output name, bytes)."""
+        # A unique prompt id and filename prefix keep concurrent inputs from seeing each other's outputs
+        output_files = ComfyClient().run(build_workflow(input_name, f"denoise/{prompt_id}"), prompt_id)
         if not output_files:
-            raise FileNotFoundError(f"No output files with an extension found in {output_dir}. Check your ComfyUI workflow. Contents: {list(p.name for p in output_dir.glob('*'))}")
-        latest_file = output_files[0]
-        return latest_file.read_bytes(), latest_file.suffix
+            raise FileNotFoundError(f"ComfyUI prompt {prompt_id} produced no output files. Check your ComfyUI workflow.")
+        return output_files[0]
+
+    def run_segmented(self, staged_path: str, prompt_id: str, segment_seconds: float, output_path: str = None):
+        """
+        Converts the input to raw PCM once, sends overlapping windows of it through
+        the workflow as separate prompts and crossfades the results into one FLAC.
+        Each prompt only ever holds one window, however long the recording is. The
+        FLAC is streamed to `output_path` if given, so memory stays bounded by the
+        window size; otherwise its bytes are returned to send back with the call.
+        The PCM is headerless, so unlike a WAV it has no 4 GB limit on length.
+        """
+        import numpy as np
+
+        pcm_path = os.path.join(COMFY_INPUT_DIR, f"{prompt_id}_full.pcm")
+        frame_bytes = SEGMENT_CHANNELS * 2
+        window_paths = []
+        subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", staged_path, "-ac", str(SEGMENT_CHANNELS),
+                        "-ar", str(SEGMENT_SAMPLE_RATE), "-f", "s16le", pcm_path], check=True)
+        try:
+            def process_window(index, start, end):
+                window_path = os.path.join(COMFY_INPUT_DIR, f"{prompt_id}_{index:04d}.wav")
+                window_paths.append(window_path)
+                with open(pcm_path, "rb") as pcm, wave.open(window_path, "wb") as window:
+                    pcm.seek(start * frame_bytes)
+                    window.setnchannels(SEGMENT_CHANNELS)
+                    window.setsampwidth(2)
+                    window.setframerate(SEGMENT_SAMPLE_RATE)
+                    window.writeframes(pcm.read((end - start) * frame_bytes))
+                _, output_bytes = self.run_prompt(os.path.basename(window_path), f"{prompt_id}_{index:04d}")
+                os.remove(window_path)
+                return decode_to_array(output_bytes)
+
+            encoder = subprocess.Popen(["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-f", "f32le", "-ac", str(SEGMENT_CHANNELS),
+                                        "-ar", str(SEGMENT_SAMPLE_RATE), "-i", "pipe:0", "-f", "flac", output_path or "pipe:1"],
+                                       stdin=subprocess.PIPE, stdout=None if output_path else subprocess.PIPE)
+            with ThreadPoolExecutor(max_workers=1) as reader:
+                encoded = reader.submit(encoder.stdout.read) if not output_path else None
+                try:
+                    for samples in process_segmented(os.path.getsize(pcm_path) // frame_bytes, round(segment_seconds * SEGMENT_SAMPLE_RATE),
+                                                     round(SEGMENT_OVERLAP_SECONDS * SEGMENT_SAMPLE_RATE), process_window):
+                        encoder.stdin.write(np.clip(samples, -1.0, 1.0).tobytes())
+                finally:
+                    encoder.stdin.close()
+                output_bytes = encoded.result() if encoded else None
+            if encoder.wait() != 0:
+                raise subprocess.CalledProcessError(encoder.returncode, "ffmpeg")
+            return output_bytes
+        finally:
+            for path in [pcm_path, *window_paths]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def denoise(self, source, output_dir: str = None, segment_seconds: float = None):
+        """
+        Denoises one input: either (name, bytes) uploaded with the call or the path
+        of a file on the cache volume, which is linked into ComfyUI's input dir
+        instead of copied. With `segment_seconds`, the input is processed in
+        overlapping windows of that length, and with `output_dir` the result is
+        encoded straight into its file. Returns (name, bytes), or (name, path)
+        when the result is written to `output_dir` on the volume.
+        """
+        prompt_id = str(uuid.uuid4())
+        name = source[0] if isinstance(source, tuple) else os.path.basename(source)
+        staged_path = os.path.join(COMFY_INPUT_DIR, f"{prompt_id}_{name}")
+        if isinstance(source, tuple):
+            with open(staged_path, "wb") as f:
+                f.write(source[1])
+        else:
+            os.symlink(source, staged_path)
+        try:
+            if segment_seconds and output_dir is not None:
+                output_name = f"{pathlib.Path(name).stem}_denoise.flac"
+                output_path = os.path.join(output_dir, output_name)
+                os.makedirs(output_dir, exist_ok=True)
+                try:
+                    self.run_segmented(staged_path, prompt_id, segment_seconds, output_path + ".part")
+                    os.replace(output_path + ".part", output_path)
+                finally:
+                    if os.path.exists(output_path + ".part"):
+                        os.remove(output_path + ".part")
+                return output_name, output_path
+            if segment_seconds:
+                output_name, output_bytes = f"{prompt_id}.flac", self.run_segmented(staged_path, prompt_id, segment_seconds)
+            else:
+                output_name, output_bytes = self.run_prompt(os.path.basename(staged_path), prompt_id)
+        finally:
+            os.remove(staged_path)
+
+        output_name = f"{pathlib.Path(name).stem}_denoise{pathlib.Path(output_name).suffix}"
+        if output_dir is None:
+            return output_name, output_bytes
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, output_name)
+        with open(output_path + ".part", "wb") as f:
+            f.write(output_bytes)
+        os.replace(output_path + ".part", output_path)
+        return output_name, output_path
+
+    @modal.method()
+    def infer(self, inputs: list, output_dir: str = None, segment_seconds: float = None):
+        """
+        Denoises a batch of inputs in this warm container and yields a record for
+        each as soon as it is ready: {"index", "name", "result"}, or {"index",
+        "error"} if that input failed. `index` is the input's position in
+        `inputs`. Several prompts are kept queued on the server.
+        """
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+            futures = {executor.submit(self.denoise, source, output_dir, segment_seconds): index
+                       for index, source in enumerate(inputs)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    output_name, result = future.result()
+                except Exception as e:
+                    yield {"index": index, "error": str(e)}
+                    continue
+                if output_dir is not None:
+                    vol.commit()
+                yield {"index": index, "name": output_name, "result": result}
 @app.local_entrypoint()
-def main():
-    output_bytes, extension = ComfyUI().infer.remote()
-    output_file_path = f"/Users/firozahmed/Downloads/{pathlib.Path(file_name).stem}_denoise{extension}"
-    with open(output_file_path, "wb") as f:
-        f.write(output_bytes)
-    print(f"File saved to {output_file_path}")
\ No newline at end of file
+def main(inputs: str = f"/Users/firozahmed/Downloads/{file_name}", output_dir: str = "", segment_seconds: float = 0):
+    """
+    `inputs` is a comma-separated list of local files (uploaded with the call) or
+    /cache/... paths already on the volume. Results are saved next to local inputs,
+    or into `output_dir` on the volume when one is given; volume inputs have no
+    local directory, so they need it. A non-zero `segment_seconds` processes long
+    recordings in overlapping windows.
+    """
+    paths = [path.strip() for path in inputs.split(",") if path.strip()]
+    if not output_dir and any(path.startswith("/cache/") for path in paths):
+        raise ValueError("Inputs on the volume need --output-dir, since there is no local directory to save to")
+    stems = [pathlib.Path(path).stem for path in paths]
+    if output_dir and len(set(stems)) < len(stems):
+        raise ValueError("Inputs with the same file name would overwrite each other's results in --output-dir")
+    sources = []
+    for path in paths:
+        if path.startswith("/cache/"):
+            sources.append(path)
+        else:
+            sources.append((os.path.basename(path), pathlib.Path(path).read_bytes()))
+
+    failed = 0
+    for record in ComfyUI().infer.remote_gen(sources, output_dir or None, segment_seconds or None):
+        path = paths[record["index"]]
+        if "error" in record:
+            print(f"✗ {path}: {record['error']}")
+            failed += 1
+        elif isinstance(record["result"], bytes):
+            result_path = os.path.join(os.path.dirname(path), record["name"])
+            with open(result_path, "wb") as f:
+                f.write(record["result"])
+            print(f"File saved to {result_path}")
+        else:
+            print(f"File written to the volume at {record['result']}")
+    if failed:
+        print(f"{failed} of {len(paths)} inputs failed.")
\ No newline at end of file
@@ -1,6 +1,10 @@
 import os
+import json
+import hashlib
+import tempfile
 from pathlib import Path
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import modal
 
 vol = modal.Volume.from_name("my-cache", create_if_missing=True)
@@ -21,46 +25,327 @@ app = modal.App(
     ]
 )
 
+MODEL_ID = "pyannote/speaker-diarization-community-1"
+CACHE_ROOT = os.environ.get("DIARIZATION_CACHE_ROOT", "/cache")  # Point at a local dir for --local runs
+DIARIZATION_CACHE_DIR = f"{CACHE_ROOT}/diarization"
+OUTPUT_DIR = f"{CACHE_ROOT}/output"
+BATCH_MANIFEST = "diarization_manifest.jsonl"  # Written next to the launcher, one line per finished input
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".flac", ".ogg", ".opus", ".webm", ".mp4")
+DECODE_SAMPLE_RATE = 16000
+DECODE_CHUNK_SECONDS = 600
+
+
+def iter_decoded_chunks(audio_path: str, chunk_seconds: float = DECODE_CHUNK_SECONDS, sample_rate: int = DECODE_SAMPLE_RATE):
+    """
+    Streams `audio_path` through ffmpeg as mono s16le at `sample_rate` and yields
+    int16 NumPy chunks of up to `chunk_seconds`. Nothing is written to disk but
+    ffmpeg's error output, which goes to an unlinked temp file so a chatty
+    decoder can't fill the stderr pipe and stall while stdout is being read.
+    """
+    import numpy as np
+
+    command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", audio_path,
+               "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+    chunk_bytes = int(chunk_seconds * sample_rate) * 2
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            while data := process.stdout.read(chunk_bytes):
+                yield np.frombuffer(data[:len(data) - len(data) % 2], dtype="<i2")
+            if process.wait() != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr.read())
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+
+def decode_audio(audio_path: str, sample_rate: int = DECODE_SAMPLE_RATE):
+    """
+    Decodes `audio_path` via a pipe into a (1, samples) float32 tensor, without
+    a temp WAV. The pipeline needs the whole waveform, so the whole file is held
+    in memory; the chunks are kept as int16 and converted once, which keeps the
+    peak at 1.5x the final tensor rather than 2x.
+    """
+    import numpy as np
+    import torch
+
+    chunks = list(iter_decoded_chunks(audio_path, sample_rate=sample_rate))
+    pcm = np.concatenate(chunks) if chunks else np.zeros(0, dtype="<i2")
+    del chunks
+    samples = np.empty(len(pcm), dtype=np.float32)
+    np.multiply(pcm, np.float32(1 / 32768), out=samples, casting="unsafe")
+    return torch.from_numpy(samples).unsqueeze(0)
+
+
+def diarization_cache_dir(waveform, model_id: str = MODEL_ID):
+    """Returns the cache directory for this decoded audio and model, keyed by a content hash."""
+    import numpy as np
+
+    # Hash the array's buffer in place; .tobytes() would copy the whole waveform
+    digest = hashlib.sha256(np.ascontiguousarray(waveform.numpy())).hexdigest()
+    return os.path.join(DIARIZATION_CACHE_DIR, model_id.replace("/", "--"), digest)
+
+
+def load_cached_diarization(cache_dir: str, num_speakers: int):
+    """Returns the cached Annotation for `num_speakers`, or None if inference hasn't run yet."""
+    from pyannote.database.util import load_rttm
+
+    rttm_path = os.path.join(cache_dir, f"speakers_{num_speakers}.rttm")
+    if not os.path.exists(rttm_path):
+        return None
+    annotations = load_rttm(rttm_path)
+    return next(iter(annotations.values())) if annotations else None
+
+
+def save_inference(cache_dir: str, segmentations, embeddings):
+    """
+    Stores the segmentation scores and per-chunk speaker embeddings, which don't
+    depend on the speaker count, so another count only needs re-clustering.
+    """
+    import numpy as np
+
+    os.makedirs(cache_dir, exist_ok=True)
+    window = segmentations.sliding_window
+    for name, array in (("segmentation", segmentations.data), ("embeddings", embeddings)):
+        np.save(os.path.join(cache_dir, f"{name}.part.npy"), array)
+        os.replace(os.path.join(cache_dir, f"{name}.part.npy"), os.path.join(cache_dir, f"{name}.npy"))
+    with open(os.path.join(cache_dir, "segmentation.json.part"), "w") as f:
+        json.dump({"start": window.start, "duration": window.duration, "step": window.step}, f)
+    os.replace(os.path.join(cache_dir, "segmentation.json.part"), os.path.join(cache_dir, "segmentation.json"))
+
+
+def load_inference(cache_dir: str):
+    """Returns the (segmentations, embeddings) saved by save_inference, or None."""
+    import numpy as np
+    from pyannote.core import SlidingWindow, SlidingWindowFeature
+
+    paths = [os.path.join(cache_dir, name) for name in ("segmentation.json", "segmentation.npy", "embeddings.npy")]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    with open(paths[0]) as f:
+        window = SlidingWindow(**json.load(f))
+    return SlidingWindowFeature(np.load(paths[1]), window), np.load(paths[2])
+
+
+def save_diarization(cache_dir: str, num_speakers: int, diarization):
+    """Stores the final RTTM for this speaker count."""
+    os.makedirs(cache_dir, exist_ok=True)
+    rttm_path = os.path.join(cache_dir, f"speakers_{num_speakers}.rttm")
+    with open(rttm_path + ".part", "w") as f:
+        diarization.write_rttm(f)
+    os.replace(rttm_path + ".part", rttm_path)
+
+
+def extract_speakers(waveform, sample_rate, diarization, speakers=None):
+    """
+    Gathers each speaker's turns from the already-loaded waveform in one pass
+    over the diarization. Segments are sliced by sample index and copied into a
+    buffer preallocated per speaker. Returns {speaker: (channels, samples) tensor}
+    for `speakers`, or for every speaker if None.
+    """
+    num_samples = waveform.shape[-1]
+    spans = {}
+    for turn, _, speaker in diarization.itertracks(yield_label=True):
+        if speakers is not None and speaker not in speakers:
+            continue
+        start = min(max(round(turn.start * sample_rate), 0), num_samples)
+        end = min(round(turn.end * sample_rate), num_samples)
+        if end > start:
+            spans.setdefault(speaker, []).append((start, end))
+
+    extracted = {}
+    for speaker, speaker_spans in spans.items():
+        buffer = waveform.new_empty((waveform.shape[0], sum(end - start for start, end in speaker_spans)))
+        position = 0
+        for start, end in speaker_spans:
+            buffer[:, position:position + end - start] = waveform[:, start:end]
+            position += end - start
+        extracted[speaker] = buffer
+    return extracted
+
+
 @app.cls(scaledown_window=300, timeout=60*60, gpu="L4")
 class Diarization:
     @modal.enter()
     def load_model(self):
         import torch
         from pyannote.audio import Pipeline
-        self.pipeline = Pipeline.from_pretrained("pyannote/speaker-diarization-community-1", token=os.environ["HF_TOKEN"]).to(torch.device("cuda"))
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.pipeline = Pipeline.from_pretrained(MODEL_ID, token=os.environ["HF_TOKEN"]).to(device)
+
+    def diarize(self, waveform, sample_rate: int, num_speakers: int):
+        """
+        Runs the pipeline, or reuses the cached result for this audio, model and
+        speaker count. For a count not seen before, the cached segmentation and
+        embeddings are re-clustered instead of running inference again.
+        """
+        cache_dir = diarization_cache_dir(waveform)
+        diarization = load_cached_diarization(cache_dir, num_speakers)
+        if diarization is not None:
+            return diarization
+
+        inference = load_inference(cache_dir)
+        if inference is not None:
+            diarization = self.recluster(*inference, num_speakers)
+            save_diarization(cache_dir, num_speakers, diarization)
+            return diarization
+
+        artifacts = {}
+
+        def hook(step_name, step_artifact, file=None, total=None, completed=None):
+            # Keep the final segmentation and embeddings, not the progress updates
+            if completed is None and step_name in ("segmentation", "embeddings"):
+                artifacts[step_name] = step_artifact
+
+        output = self.pipeline({"waveform": waveform, "sample_rate": sample_rate}, num_speakers=num_speakers, hook=hook)
+        diarization = output.speaker_diarization
+        if "segmentation" in artifacts and "embeddings" in artifacts:
+            save_inference(cache_dir, artifacts["segmentation"], artifacts["embeddings"])
+        save_diarization(cache_dir, num_speakers, diarization)
+        return diarization
+
+    def recluster(self, segmentations, embeddings, num_speakers: int):
+        """
+        Repeats the steps of the pipeline that follow embedding extraction:
+        speaker counting, clustering into `num_speakers` and reconstruction.
+        """
+        import numpy as np
+        from pyannote.audio.utils.signal import binarize
+
+        pipeline = self.pipeline
+        frames = pipeline._segmentation.model.receptive_field
+        if pipeline._segmentation.model.specifications.powerset:
+            binarized = segmentations
+        else:
+            binarized = binarize(segmentations, onset=pipeline.segmentation.threshold, initial_state=False)
+        count = pipeline.speaker_count(binarized, frames, warm_up=(0.0, 0.0))
+        hard_clusters, _, _ = pipeline.clustering(embeddings=embeddings, segmentations=binarized, num_clusters=num_speakers,
+                                                  min_clusters=num_speakers, max_clusters=num_speakers, frames=frames)
+        count.data = np.minimum(count.data, num_speakers).astype(np.int8)
+        hard_clusters[np.sum(binarized.data, axis=1) == 0] = -2  # Inactive speakers
+        discrete = pipeline.reconstruct(segmentations, hard_clusters, count)
+        diarization = pipeline.to_annotation(discrete, min_duration_on=0.0,
+                                             min_duration_off=pipeline.segmentation.min_duration_off)
+        return diarization.rename_labels(mapping=dict(zip(diarization.labels(), pipeline.classes())))
         
-    @modal.method()
-    def run_diarization(self, audio_path: str):
-        import torch
+    def export(self, audio_path: str, waveform, all_speakers: bool, num_speakers: int, speaker: str = None,
+               delete_input: bool = True):
+        """
+        Diarizes an already-decoded file, saves the speaker audio and returns a
+        manifest record. `delete_input` removes the input afterwards, for files
+        staged on the volume only to be processed.
+        """
         import torchaudio
-        from pyannote.audio import Audio
-        
-        # Convert to WAV
-        wav_path = f"/tmp/{Path(audio_path).stem}.wav"
-        subprocess.run(["ffmpeg", "-y", "-i", audio_path, "-ac", "1", "-ar", "16000", wav_path], check=True, capture_output=True)
 
-        waveform, sample_rate = torchaudio.load(wav_path)
-        output = self.pipeline({"waveform": waveform, "sample_rate": sample_rate}, num_speakers=2)
+        sample_rate = DECODE_SAMPLE_RATE
+        diarization = self.diarize(waveform, sample_rate, num_speakers)
 
-        diarization = output.speaker_diarization
         speakers = diarization.labels()
-        first_speaker = speakers[0]
-        
-        audio = Audio()
-        speaker_audio = None
+        target_speaker = speaker or speakers[0]
+        extracted = extract_speakers(waveform, sample_rate, diarization, None if all_speakers else {target_speaker})
         
-        for turn, _, speaker in diarization.itertracks(yield_label=True):
-            if speaker == first_speaker:
-                segment_audio = audio.crop(wav_path, turn)[0]
-                speaker_audio = segment_audio if speaker_audio is None else torch.cat((speaker_audio, segment_audio), dim=1)
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        output_path = f"{OUTPUT_DIR}/{Path(audio_path).stem}.wav"
+        torchaudio.save(output_path, extracted[target_speaker], sample_rate)
+        outputs = [output_path]
+        if all_speakers:
+            for label, speaker_audio in extracted.items():
+                outputs.append(f"{OUTPUT_DIR}/{Path(audio_path).stem}_{label}.wav")
+                torchaudio.save(outputs[-1], speaker_audio, sample_rate)
         
-        os.makedirs("/cache/output", exist_ok=True)
-        output_path = f"/cache/output/{Path(audio_path).stem}.wav"
-        torchaudio.save(output_path, speaker_audio, sample_rate)
+        if delete_input:
+            os.remove(audio_path)
+        return {"input": audio_path, "outputs": outputs, "speakers": speakers}
         
-        os.remove(wav_path)
-        os.remove(audio_path)
+    @modal.method()
+    def run_diarization(self, audio_path: str, all_speakers: bool = False, num_speakers: int = 2, speaker: str = None,
+                        delete_input: bool = True):
+        # Decode straight into memory as 16 kHz mono
+        return self.export(audio_path, decode_audio(audio_path), all_speakers, num_speakers, speaker, delete_input)
+
+    @modal.method()
+    def run_batch(self, audio_paths: list, all_speakers: bool = False, num_speakers: int = 2,
+                  delete_input: bool = True):
+        """
+        Diarizes several files in one container. The next file is decoded on a
+        background thread while the model runs on the current one, so the GPU
+        isn't idle during ffmpeg and disk I/O. Failures are recorded per file.
+        """
+        results = []
+        with ThreadPoolExecutor(max_workers=1) as decoder:
+            pending = decoder.submit(decode_audio, audio_paths[0]) if audio_paths else None
+            for index, audio_path in enumerate(audio_paths):
+                current = pending
+                pending = decoder.submit(decode_audio, audio_paths[index + 1]) if index + 1 < len(audio_paths) else None
+                try:
+                    results.append(self.export(audio_path, current.result(), all_speakers, num_speakers,
+                                               delete_input=delete_input))
+                except Exception as e:
+                    print(f"✗ {audio_path}: {e}")
+                    results.append({"input": audio_path, "error": str(e)})
+        return results
+
+
+def collect_inputs(source: str, local: bool):
+    """
+    Returns the audio paths to process. `source` is either a manifest (one path
+    per line) or a directory: a local one for --local runs, otherwise a
+    directory on the volume such as /cache/input.
+    """
+    if os.path.isfile(source):
+        with open(source) as f:
+            return [line.strip() for line in f if line.strip()]
+    if local:
+        paths = [str(path) for path in Path(source).rglob("*")]
+    else:
+        relative = os.path.relpath(source, "/cache")
+        paths = [f"/cache/{entry.path}" for entry in vol.listdir(relative, recursive=True)]
+    return sorted(path for path in paths if path.lower().endswith(AUDIO_EXTENSIONS))
+
+
+def load_finished(manifest_path: str = BATCH_MANIFEST):
+    """Returns the inputs recorded as finished in the batch manifest."""
+    if not os.path.exists(manifest_path):
+        return set()
+    with open(manifest_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return {record["input"] for record in records if "error" not in record}
+
 
 @app.local_entrypoint()
-def main():
-    Diarization().run_diarization.remote()
\ No newline at end of file
+def main(source: str = "/cache/input", batch_size: int = 4, all_speakers: bool = False,
+         num_speakers: int = 2, local: bool = False):
+    """
+    Diarizes every input under `source`, skipping files already in the manifest.
+    Batches fan out across containers with .map; --local runs them one after
+    another in this process instead, as a stand-in for the Modal runtime, and
+    leave the input files in place.
+    """
+    finished = load_finished()
+    audio_paths = [path for path in collect_inputs(source, local) if path not in finished]
+    print(f"{len(audio_paths)} files to diarize ({len(finished)} already finished).")
+    batches = [audio_paths[i:i + batch_size] for i in range(0, len(audio_paths), batch_size)]
+    # Inputs on the volume were staged there for this job; local files are the user's originals
+    options = {"all_speakers": all_speakers, "num_speakers": num_speakers, "delete_input": not local}
+
+    if local:
+        model = Diarization()
+        results = (model.run_batch.local(batch, **options) for batch in batches)
+    else:
+        results = Diarization().run_batch.map(batches, kwargs=options, order_outputs=False, return_exceptions=True)
+
+    failed = failed_batches = 0
+    with open(BATCH_MANIFEST, "a") as manifest:
+        for batch_results in results:
+            if isinstance(batch_results, Exception):
+                print(f"✗ Batch failed: {batch_results}")
+                failed_batches += 1
+                continue
+            for record in batch_results:
+                failed += "error" in record
+                manifest.write(json.dumps(record) + "\n")
+                manifest.flush()
+    print(f"Done. {failed} files and {failed_batches} batches failed; rerun to retry them.")
\ No newline at end of file
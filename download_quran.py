@@ -1,111 +1,419 @@
 import requests
 import os
+import argparse
+import time
+import heapq
+import itertools
 import concurrent.futures
+from collections import namedtuple
 from tqdm import tqdm
+from http_utils import backoff_delay, file_md5, get_session, parse_retry_after
+from state_db import StateDB
 
 # --- Configuration ---
-MAX_WORKERS = 8
+INITIAL_WORKERS = 8
+MIN_WORKERS = 1
+MAX_WORKERS = 64  # Upper bound for the adaptive concurrency controller
 OUTPUT_DIR = "Quran_Audio"
+MANIFEST_PATH = os.path.join(OUTPUT_DIR, ".download_manifest.sqlite")
+MANIFEST_COMMIT_EVERY = 100  # Batch manifest commits to keep fsyncs off the hot path
+VERIFY_WORKERS = 16
 CHUNK_SIZE = 8192  # Download in chunks to save memory
 
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1.0  # Seconds before the first retry
+BACKOFF_CAP = 60.0  # Longest wait between two attempts of the same file
+ERROR_RATE_THRESHOLD = 0.05  # Back off when more than 5% of a window fails
+DECREASE_COOLDOWN = 2.0  # Seconds between two throttle-driven halvings
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
 BASE_URL = "https://d36m9bni5rssex.cloudfront.net/ayah-by-ayah/"
 QUERY_PARAMS = os.environ.get("QUERY_PARAMS")
 AYAH_COUNTS = [0, 7, 286, 200, 176, 120, 165, 206, 75, 129, 109, 123, 111, 43, 52, 99, 128, 111, 110, 98, 135, 112, 78, 118, 64, 77, 227, 93, 88, 69, 60, 34, 30, 73, 54, 45, 83, 182, 88, 75, 85, 54, 53, 89, 59, 37, 35, 38, 29, 18, 45, 60, 49, 62, 55, 78, 96, 29, 22, 24, 13, 14, 11, 11, 18, 12, 12, 30, 52, 52, 44, 28, 28, 20, 56, 40, 31, 50, 40, 46, 42, 29, 19, 36, 25, 22, 17, 19, 26, 30, 20, 15, 21, 11, 8, 8, 19, 5, 8, 8, 11, 11, 8, 3, 9, 5, 4, 7, 3, 6, 3, 5, 4, 5, 6]
 
 
+# A failed attempt. `retryable` is False for errors a retry can't fix (e.g. 404),
+# `throttled` marks responses that ask us to slow down, and `retry_after` holds
+# the server's requested delay in seconds, if it sent one.
+DownloadFailure = namedtuple("DownloadFailure", ["message", "retryable", "throttled", "retry_after"])
+
+
+class ConcurrencyController:
+    """
+    AIMD controller for the number of downloads in flight.
+
+    Completions are judged in windows of roughly `limit` files. A window that
+    saw throttling or an error rate above ERROR_RATE_THRESHOLD halves the limit;
+    otherwise the limit grows by one as long as throughput keeps up with the
+    best window seen so far.
+    """
+
+    def __init__(self, initial=INITIAL_WORKERS, minimum=MIN_WORKERS, maximum=MAX_WORKERS):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(maximum, initial))
+        self.best_throughput = 0.0
+        self.last_decrease = 0.0
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_started = time.monotonic()
+        self.window_done = 0
+        self.window_errors = 0
+        self.window_throttled = False
+
+    def record(self, success, throttled=False):
+        """Records one finished attempt and adjusts the limit at window end."""
+        self.window_done += 1
+        if not success:
+            self.window_errors += 1
+        self.window_throttled = self.window_throttled or throttled
+
+        if self.window_throttled:
+            # React to throttling immediately instead of waiting out the window,
+            # but let one burst of 429s from the same window count only once.
+            now = time.monotonic()
+            if now - self.last_decrease >= DECREASE_COOLDOWN:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.last_decrease = now
+            self._reset_window()
+            return
+        if self.window_done < max(self.limit, 4):
+            return
+
+        elapsed = max(time.monotonic() - self.window_started, 1e-6)
+        throughput = (self.window_done - self.window_errors) / elapsed
+        error_rate = self.window_errors / self.window_done
+
+        if error_rate > ERROR_RATE_THRESHOLD:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.last_decrease = time.monotonic()
+        elif throughput >= self.best_throughput * 0.95:
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            # More workers stopped helping: settle one step lower.
+            self.limit = max(self.minimum, self.limit - 1)
+        self.best_throughput = max(self.best_throughput, throughput)
+        self._reset_window()
+
+
+def expected_total_size(response):
+    """
+    Returns the full size of the remote file according to the response, or None.
+    For a 206 this is the total after the slash in Content-Range.
+    """
+    if response.status_code == 206:
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+class DownloadManifest(StateDB):
+    """
+    Every completed download, with its URL, size, ETag, the server-reported
+    Content-Length and an MD5 of the file on disk.
+
+    Planning a run is a single SELECT over this table instead of a stat call
+    for each of the 6,236 ayahs. Only the main thread writes to it.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS files (
+               filepath TEXT PRIMARY KEY,
+               url TEXT NOT NULL,
+               size INTEGER NOT NULL,
+               etag TEXT,
+               content_length INTEGER,
+               md5 TEXT NOT NULL,
+               completed_at REAL NOT NULL
+           )""",
+    )
+
+    def __init__(self, path=MANIFEST_PATH):
+        super().__init__(path)
+        self._uncommitted = 0
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def completed_paths(self):
+        """Returns the set of file paths recorded as complete."""
+        return {row[0] for row in self.conn.execute("SELECT filepath FROM files")}
+
+    def entries(self):
+        """Returns every manifest row as a dict."""
+        cursor = self.conn.execute("SELECT filepath, url, size, etag, content_length, md5 FROM files")
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def record(self, task_info):
+        """Stores the metadata download_ayah_once left on a finished task."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (task_info['filepath'], task_info['remote_url'], task_info['size'],
+             task_info.get('etag'), task_info.get('content_length'), task_info['md5'], time.time()),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= MANIFEST_COMMIT_EVERY:
+            self.commit()
+
+    def remove(self, filepath):
+        self.conn.execute("DELETE FROM files WHERE filepath = ?", (filepath,))
+        self._uncommitted += 1
+
+    def commit(self):
+        super().commit()
+        self._uncommitted = 0
+
+
 def download_ayah_once(task_info):
     """
     Downloads a file to a temporary .part location in a single attempt.
-    Renames the file on success. Cleans up partial files on failure.
+    If a .part file is left over from an interrupted run, the download resumes
+    from its end with an HTTP Range request. Renames the file on success.
+    Partial files are kept on failure so the next attempt can resume them.
+    Returns None on success or a DownloadFailure describing the error.
+    On success the file's size, MD5, ETag and Content-Length are stored on
+    task_info for the manifest.
     """
     url = task_info['url']
     final_filepath = task_info['filepath']
     temp_filepath = final_filepath + ".part"
     filename = task_info['filename']
 
+    resume_from = os.path.getsize(temp_filepath) if os.path.exists(temp_filepath) else 0
+    headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+
     try:
-        response = requests.get(url, stream=True, timeout=30)
-        # Raise an exception for bad status codes (4xx or 5xx)
-        response.raise_for_status()
-
-        with open(temp_filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                f.write(chunk)
-        
-        # Verify the downloaded file is not empty before renaming
-        if os.path.getsize(temp_filepath) > 0:
-            os.rename(temp_filepath, final_filepath)
-            return None  # Return None on success
-        else:
-            return f"Failed {filename} (Downloaded file is empty)"
-
-    except requests.exceptions.RequestException as e:
-        return f"Failed {filename} (Error: {e})"
-    finally:
-        # This block ensures the temporary file is removed after the try/except
-        if os.path.exists(temp_filepath):
-            try:
+        os.makedirs(os.path.dirname(final_filepath), exist_ok=True)
+        session = get_session()
+        with session.get(url, stream=True, timeout=30, headers=headers) as response:
+            if response.status_code == 416:
+                # The server can't satisfy the range: the partial file is stale
+                # or already complete. Discard it and start over next time.
                 os.remove(temp_filepath)
-            except OSError:
-                pass
+                return DownloadFailure(f"Failed {filename} (Stale partial file discarded)", True, False, 0.0)
 
+            if response.status_code >= 400:
+                status = response.status_code
+                return DownloadFailure(
+                    f"Failed {filename} (HTTP {status})",
+                    status in RETRYABLE_STATUS_CODES,
+                    status in THROTTLE_STATUS_CODES,
+                    parse_retry_after(response.headers.get("Retry-After")),
+                )
 
-def download_quran_audio():
-    """Main function to scan for missing files and download them."""
-    print("Scanning for missing audio files...")
-    
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
-    
-    tasks_to_run = []
-    for surah_number in range(1, 115):
+            # 206 means the server honoured the Range header; anything else is
+            # the full body, so the partial file must be overwritten.
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            with open(temp_filepath, mode) as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+            content_length = expected_total_size(response)
+            etag = response.headers.get("ETag")
+
+        # Verify the downloaded file is complete before renaming
+        size = os.path.getsize(temp_filepath)
+        if size == 0:
+            os.remove(temp_filepath)
+            return DownloadFailure(f"Failed {filename} (Downloaded file is empty)", True, False, None)
+        if content_length is not None and size != content_length:
+            if size > content_length:
+                # Can't be resumed from: the partial file holds bytes the server never sent.
+                os.remove(temp_filepath)
+            return DownloadFailure(
+                f"Failed {filename} (Got {size} of {content_length} bytes)", True, False, None
+            )
+
+        os.replace(temp_filepath, final_filepath)
+        task_info.update(size=size, etag=etag, content_length=content_length, md5=file_md5(final_filepath))
+        return None  # Return None on success
+
+    except (requests.exceptions.RequestException, OSError) as e:
+        # Timeouts, resets and truncated bodies are all worth another attempt.
+        return DownloadFailure(f"Failed {filename} (Error: {e})", True, False, None)
+
+
+def run_download_scheduler(tasks_to_run, on_success=None, controller=None):
+    """
+    Runs the downloads with retries and adaptive concurrency.
+
+    A single thread pool sized for MAX_WORKERS does the work, while the
+    ConcurrencyController decides how many downloads may be in flight at once.
+    Retryable failures go back on the queue with a backoff delay instead of
+    failing the whole file. on_success(task) is called from this thread for
+    every finished file. Pass a `controller` to carry what it has learned
+    across several calls. Returns (failed_downloads, controller).
+    """
+    if controller is None:
+        controller = ConcurrencyController()
+    order = itertools.count()
+    pending = [(0.0, next(order), task) for task in tasks_to_run]  # heap of (not_before, seq, task)
+    attempts = {}
+    failed_downloads = []
+    in_flight = {}
+    retrying = 0  # Pending tasks that have already failed at least once
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        with tqdm(total=len(tasks_to_run), desc="Downloading", unit="file") as pbar:
+            while pending or in_flight:
+                now = time.monotonic()
+                while pending and len(in_flight) < controller.limit and pending[0][0] <= now:
+                    _, _, task = heapq.heappop(pending)
+                    if task['filepath'] in attempts:
+                        retrying -= 1
+                    attempts[task['filepath']] = attempts.get(task['filepath'], 0) + 1
+                    in_flight[executor.submit(download_ayah_once, task)] = task
+
+                if not in_flight:
+                    # Everything left is waiting out a backoff delay.
+                    time.sleep(max(0.0, pending[0][0] - now))
+                    continue
+
+                # Wake for the next backoff deadline only if a slot is free to start it;
+                # while saturated, only a completion can change anything.
+                slot_free = len(in_flight) < controller.limit
+                timeout = max(0.0, pending[0][0] - now) if pending and slot_free else None
+                done, _ = concurrent.futures.wait(
+                    in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    task = in_flight.pop(future)
+                    failure = future.result()
+                    controller.record(failure is None, failure is not None and failure.throttled)
+
+                    if failure is None:
+                        if on_success:
+                            on_success(task)
+                        pbar.update(1)
+                    elif failure.retryable and attempts[task['filepath']] < MAX_ATTEMPTS:
+                        delay = backoff_delay(attempts[task['filepath']], failure.retry_after, BACKOFF_BASE, BACKOFF_CAP)
+                        heapq.heappush(pending, (time.monotonic() + delay, next(order), task))
+                        retrying += 1
+                    else:
+                        failed_downloads.append(failure.message)
+                        tqdm.write(f"✗ {failure.message}") # Print errors without disturbing the bar
+                        pbar.update(1)
+                pbar.set_postfix(workers=controller.limit, retrying=retrying, refresh=False)
+
+    return failed_downloads, controller
+
+
+def all_ayah_tasks(surah_numbers=range(1, 115)):
+    """Yields a download task for every ayah of the given surahs, in surah/ayah order."""
+    for surah_number in surah_numbers:
         surah_dir = os.path.join(OUTPUT_DIR, f"Surah_{surah_number:03d}")
-        if not os.path.exists(surah_dir):
-            os.makedirs(surah_dir)
-            
         num_ayahs = AYAH_COUNTS[surah_number]
         for ayah_number in range(1, num_ayahs + 1):
             local_filename = f"{surah_number:03d}_{ayah_number:03d}.mp3"
-            local_filepath = os.path.join(surah_dir, local_filename)
-            
-            if os.path.exists(local_filepath) and os.path.getsize(local_filepath) > 0:
-                continue
-                
-            remote_filename = f"{surah_number:03d}{ayah_number:03d}.mp3"
-            url = f"{BASE_URL}{remote_filename}{QUERY_PARAMS}"
-            tasks_to_run.append({
-                "url": url,
-                "filepath": local_filepath,
+            remote_url = f"{BASE_URL}{surah_number:03d}{ayah_number:03d}.mp3"
+            yield {
+                "url": f"{remote_url}{QUERY_PARAMS}",
+                "remote_url": remote_url,
+                "filepath": os.path.join(surah_dir, local_filename),
                 "filename": local_filename
-            })
+            }
+
+
+def adopt_existing_files(manifest):
+    """
+    One-time migration for trees downloaded before the manifest existed:
+    records every non-empty file already on disk. Their Content-Length is
+    unknown, so a later --verify run checks them against the server.
+    """
+    adopted = 0
+    for task in all_ayah_tasks():
+        filepath = task['filepath']
+        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            task.update(size=os.path.getsize(filepath), md5=file_md5(filepath))
+            manifest.record(task)
+            adopted += 1
+    manifest.commit()
+    return adopted
+
+
+def verify_entry(entry):
+    """
+    Checks one manifest entry against the file on disk (and, if its
+    Content-Length was never recorded, against the server).
+    Returns a reason string if the file is missing or corrupt, else None.
+    """
+    filepath = entry['filepath']
+    try:
+        size = os.path.getsize(filepath)
+    except OSError:
+        return "missing"
+    if size != entry['size']:
+        return f"size {size} != {entry['size']}"
+    expected = entry['content_length']
+    if expected is None:
+        try:
+            response = get_session().head(f"{entry['url']}{QUERY_PARAMS}", timeout=30, allow_redirects=True)
+            length = response.headers.get("Content-Length")
+            expected = int(length) if response.ok and length and length.isdigit() else None
+        except requests.exceptions.RequestException:
+            expected = None
+    if expected is not None and size != expected:
+        return f"size {size} != server {expected}"
+    if file_md5(filepath) != entry['md5']:
+        return "checksum mismatch"
+    return None
+
+
+def verify_manifest(manifest):
+    """
+    Re-checks every recorded file in parallel. Corrupt or missing files are
+    deleted and dropped from the manifest so the next planning step re-queues them.
+    """
+    entries = manifest.entries()
+    corrupt = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        results = executor.map(verify_entry, entries)
+        for entry, reason in tqdm(zip(entries, results), total=len(entries), desc="Verifying", unit="file"):
+            if reason is None:
+                continue
+            corrupt += 1
+            tqdm.write(f"✗ {os.path.basename(entry['filepath'])} is corrupt ({reason}), re-queueing")
+            if os.path.exists(entry['filepath']):
+                os.remove(entry['filepath'])
+            manifest.remove(entry['filepath'])
+    manifest.commit()
+    print(f"Verified {len(entries)} files, {corrupt} re-queued.")
+
+
+def download_quran_audio(verify=False):
+    """
+    Main function to plan missing files from the manifest and download them.
+    With verify=True, every recorded file is re-checked first.
+    """
+    with DownloadManifest() as manifest:
+        if manifest.is_empty() and os.path.isdir(OUTPUT_DIR):
+            adopted = adopt_existing_files(manifest)
+            if adopted:
+                print(f"Recorded {adopted} previously downloaded files in the manifest.")
+        if verify:
+            verify_manifest(manifest)
+
+        print("Planning downloads from the manifest...")
+        completed = manifest.completed_paths()
+        tasks_to_run = [task for task in all_ayah_tasks() if task['filepath'] not in completed]
+
+        if tasks_to_run:
+            print(f"Found {len(tasks_to_run)} files to download. Starting...\n")
+            failed_downloads, controller = run_download_scheduler(tasks_to_run, on_success=manifest.record)
 
     if not tasks_to_run:
         print("✓ All Quran audio files are already downloaded.")
         return
 
-    print(f"Found {len(tasks_to_run)} files to download. Starting...\n")
-
-    failed_downloads = []
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all tasks to the executor
-        future_to_task = {executor.submit(download_ayah_once, task): task for task in tasks_to_run}
-        
-        # Process results as they complete with a progress bar
-        with tqdm(total=len(tasks_to_run), desc="Downloading", unit="file") as pbar:
-            for future in concurrent.futures.as_completed(future_to_task):
-                error = future.result()
-                
-                if error:
-                    failed_downloads.append(error)
-                    tqdm.write(f"✗ {error}") # Print errors without disturbing the bar
-                
-                pbar.update(1)
-
     # Final summary report
     print(f"\n{'='*60}")
     print("Download process completed.")
     print(f"Successfully downloaded: {len(tasks_to_run) - len(failed_downloads)}/{len(tasks_to_run)}")
+    print(f"Settled concurrency: {controller.limit} workers "
+          f"(best throughput {controller.best_throughput:.1f} files/s)")
     
     if failed_downloads:
         print(f"\n⚠ Failed downloads ({len(failed_downloads)}):")
@@ -117,4 +425,8 @@ def download_quran_audio():
 
 
 if __name__ == "__main__":
-    download_quran_audio()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Download ayah-by-ayah Quran audio.")
+    parser.add_argument("--verify", action="store_true",
+                        help="Re-check every downloaded file and re-queue corrupt ones.")
+    args = parser.parse_args()
+    download_quran_audio(verify=args.verify)
\ No newline at end of file
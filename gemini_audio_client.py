@@ -1,167 +1,1120 @@
 # gemini_audio_client.py
 
 import asyncio
+import contextlib
+import filecmp
+import hashlib
+import json
+import math
 import os
+import random
+import shutil
+import time
+import wave
+import zlib
 import numpy as np
 from google import genai
+from google.genai import errors as genai_errors
 from google.genai.types import (Content, LiveConnectConfig, Part,
                                 PrebuiltVoiceConfig, SpeechConfig,
                                 VoiceConfig)
 from tqdm.asyncio import tqdm
 from pydub import AudioSegment
+from concurrent.futures import ProcessPoolExecutor
 from typing import Callable, Tuple, Optional
+from websockets.exceptions import ConnectionClosed
+
+try:
+    import soundfile  # Encodes in-process through libsndfile, no ffmpeg spawn per file
+except ImportError:
+    soundfile = None
 
 # --- API-SPECIFIC CONFIGURATION ---
 MODEL_NAME = "models/gemini-2.5-flash-native-audio-preview-09-2025"
 VOICE_NAME = "Charon"
 DEFAULT_SAMPLE_RATE = 24000
+METRICS_FILE = "tts_metrics.jsonl"  # Per-request timings, one JSON object per line
+PROGRESS_INTERVAL = 0.5  # Seconds between progress_fn calls
+METRICS_SAMPLE_SIZE = 10000  # Timings kept per phase for percentiles; memory stays flat past this
+
+# --- OUTPUT ENCODING CONFIGURATION ---
+DEFAULT_OUTPUT_FORMAT = "mp3"
+ENCODER_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# format -> (file extension, libsndfile format, libsndfile subtype, pydub/ffmpeg format)
+OUTPUT_FORMATS = {
+    "mp3": (".mp3", "MP3", "MPEG_LAYER_III", "mp3"),
+    "opus": (".opus", "OGG", "OPUS", "opus"),
+    "flac": (".flac", "FLAC", "PCM_16", "flac"),
+    "wav": (".wav", "WAV", "PCM_16", "wav"),
+}
+MP3_BITRATE = "64k"  # Constant bitrate, through libsndfile or the pydub/ffmpeg fallback
+
+# --- SYNTHESIS CACHE CONFIGURATION ---
+# Relative to the working directory, like tts.py's audio/ outputs, so both
+# usually share a filesystem and entries can be hardlinked rather than copied.
+CACHE_DIR = ".tts_cache"
+CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+# --- RETRY AND RATE-LIMIT CONFIGURATION ---
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2.0   # Seconds before the first retry
+BACKOFF_CAP = 120.0  # Longest wait between two attempts of the same line
+THROTTLE_COOLDOWN = 5.0  # Seconds between two throttle-driven concurrency halvings
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+THROTTLE_MARKERS = ("RESOURCE_EXHAUSTED", "quota", "rate limit")
+
+# --- SESSION POOL CONFIGURATION ---
+# A live session keeps the conversation so far in context, so sessions are
+# recycled after a number of turns (and before the server's session time limit)
+# to keep per-turn token cost from growing.
+SESSION_MAX_TURNS = 20
+SESSION_MAX_AGE = 8 * 60  # Seconds
 
 # --- INITIALIZE THE CLIENT AND CONFIG ---
-try:
-    client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
-    config = LiveConnectConfig(
+def build_live_config(system_instruction: str | None = None) -> LiveConnectConfig:
+    """
+    Builds the live session config. A `system_instruction` is sent once when
+    a session opens, instead of being repeated in every user turn.
+    """
+    return LiveConnectConfig(
         response_modalities=["AUDIO"],
         speech_config=SpeechConfig(
             voice_config=VoiceConfig(
                 prebuilt_voice_config=PrebuiltVoiceConfig(voice_name=VOICE_NAME)
             )
         ),
+        system_instruction=(
+            Content(parts=[Part(text=system_instruction)]) if system_instruction else None
+        ),
     )
+
+try:
+    client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+    config = build_live_config()
 except KeyError:
     print("FATAL: GEMINI_API_KEY environment variable not set.")
     client = None
     config = None
 
-async def fetch_audio_data(prompt_text: str) -> np.ndarray | None:
+class EmptyAudioError(Exception):
+    """The model finished its turn without sending any audio."""
+
+
+def classify_error(error: Exception) -> Tuple[bool, bool]:
     """
-    Connects to the Gemini API with a given prompt and fetches the audio.
-    Returns a NumPy array of the audio data on success, or None on failure.
+    Sorts an exception from a live session into (retryable, throttled).
+    Quota errors and dropped websockets are worth retrying; bad requests,
+    auth failures and local errors (e.g. a failed MP3 export) are not.
     """
-    if not client:
-        print("API client is not initialized. Cannot fetch audio.")
-        return None
-        
-    try:
-        async with client.aio.live.connect(model=MODEL_NAME, config=config) as session:
-            await session.send_client_content(
-                turns=Content(role="user", parts=[Part(text=prompt_text)])
+    message = str(error)
+    throttled = any(marker.lower() in message.lower() for marker in THROTTLE_MARKERS)
+    if isinstance(error, genai_errors.APIError):
+        throttled = throttled or error.code == 429
+        return error.code in RETRYABLE_STATUS_CODES or throttled, throttled
+    if isinstance(error, (ConnectionClosed, EmptyAudioError, asyncio.TimeoutError, ConnectionError)):
+        return True, throttled
+    return False, False
+
+
+class TokenBucket:
+    """
+    Async token bucket that spreads live-session starts over a per-minute
+    budget. Turns on an already open pooled session don't take a token.
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int | None = None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst or max(1, int(self.rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class LiveRequestScheduler:
+    """
+    Admission control for live sessions: a concurrent-session limit that
+    halves when the API throttles us and creeps back up by one session per
+    `limit` successes (AIMD). The per-minute budget is a TokenBucket taken
+    where sessions are opened.
+    """
+
+    def __init__(self, max_sessions: int, max_attempts: int = MAX_ATTEMPTS):
+        self.max_sessions = max_sessions
+        self.limit = float(max_sessions)
+        self.in_use = 0
+        self.max_attempts = max_attempts
+        self.last_throttle = 0.0
+        self._changed = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_use < int(self.limit))
+            self.in_use += 1
+
+    async def release(self):
+        async with self._changed:
+            self.in_use -= 1
+            self._changed.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.max_sessions, self.limit + 1 / self.limit)
+
+    def on_throttled(self):
+        now = time.monotonic()
+        if now - self.last_throttle >= THROTTLE_COOLDOWN:
+            self.limit = max(1.0, self.limit / 2)
+            self.last_throttle = now
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given (1-based) attempt."""
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+class PooledSession:
+    """A live session held open by LiveSessionPool, plus its recycling state."""
+
+    def __init__(self, stack: contextlib.AsyncExitStack, session):
+        self.stack = stack
+        self.session = session
+        self.opened = time.monotonic()
+        self.turns = 0
+        self.healthy = True
+
+    def reusable(self, max_turns: int, max_age: float) -> bool:
+        return (self.healthy and self.turns < max_turns
+                and time.monotonic() - self.opened < max_age)
+
+
+class LiveSessionPool:
+    """
+    Keeps up to `size` live sessions open and hands them out one turn at a
+    time, so a websocket and session handshake is paid once per session
+    rather than once per line.
+
+    A session is closed instead of returned to the pool when its turn raised
+    (the stream may hold half a turn), when the server sent GoAway, or once it
+    reaches `max_turns` turns or `max_age` seconds. Each new session takes a
+    token from `session_starts`, if given.
+    """
+
+    def __init__(self, size: int, live_config: LiveConnectConfig | None = None,
+                 max_turns: int = SESSION_MAX_TURNS, max_age: float = SESSION_MAX_AGE,
+                 session_starts: TokenBucket | None = None):
+        self.size = size
+        self.live_config = live_config
+        self.session_starts = session_starts
+        self.max_turns = max_turns
+        self.max_age = max_age
+        self.opened_total = 0
+        self._idle = []
+        self._open = 0
+        self._changed = asyncio.Condition()
+
+    async def _connect(self) -> PooledSession:
+        if self.session_starts:
+            await self.session_starts.acquire()
+        stack = contextlib.AsyncExitStack()
+        try:
+            session = await stack.enter_async_context(
+                client.aio.live.connect(model=MODEL_NAME, config=self.live_config or config)
             )
+        except BaseException:
+            await stack.aclose()
+            raise
+        self.opened_total += 1
+        return PooledSession(stack, session)
 
-            audio_data_chunks = []
-            async for message in session.receive():
-                if message.server_content.model_turn and message.server_content.model_turn.parts:
-                    for part in message.server_content.model_turn.parts:
-                        if part.inline_data:
-                            audio_data_chunks.append(np.frombuffer(part.inline_data.data, dtype=np.int16))
+    async def _close(self, pooled: PooledSession):
+        try:
+            await pooled.stack.aclose()
+        except Exception:
+            pass  # The session is being dropped anyway
+        async with self._changed:
+            self._open -= 1
+            self._changed.notify()
 
-            if audio_data_chunks:
-                return np.concatenate(audio_data_chunks)
-            else:
-                return None
+    async def _acquire(self) -> PooledSession:
+        while True:
+            stale = None
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._idle or self._open < self.size)
+                if self._idle:
+                    pooled = self._idle.pop()
+                    if pooled.reusable(self.max_turns, self.max_age):
+                        return pooled
+                    stale = pooled
+                else:
+                    self._open += 1
+            if stale is not None:
+                await self._close(stale)
+                continue
+            try:
+                return await self._connect()
+            except BaseException:
+                async with self._changed:
+                    self._open -= 1
+                    self._changed.notify()
+                raise
+
+    async def _release(self, pooled: PooledSession):
+        pooled.turns += 1
+        if not pooled.reusable(self.max_turns, self.max_age):
+            await self._close(pooled)
+            return
+        async with self._changed:
+            self._idle.append(pooled)
+            self._changed.notify()
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """Borrows a session for exactly one turn."""
+        pooled = await self._acquire()
+        try:
+            yield pooled
+        except BaseException:
+            pooled.healthy = False
+            raise
+        finally:
+            await self._release(pooled)
+
+    async def close(self):
+        """Closes every idle session. Call once all turns have finished."""
+        idle, self._idle = self._idle, []
+        for pooled in idle:
+            await self._close(pooled)
+
+
+class ArraySink:
+    """Collects received PCM chunks in memory; used for one-off requests."""
+
+    def __init__(self):
+        self.chunks = []
+        self.bytes_written = 0
+
+    def write(self, data: bytes):
+        self.chunks.append(np.frombuffer(data, dtype=np.int16))
+        self.bytes_written += len(data)
+
+    def to_array(self) -> np.ndarray:
+        return np.concatenate(self.chunks)
+
+
+class WavFileSink:
+    """
+    Streams received PCM chunks straight into a temporary WAV file next to
+    `output_path`, so a task never holds more than one chunk in memory.
+
+    Nothing appears at `output_path` until `commit()` renames the finished
+    file into place. `abort()` (or leaving the `with` block on an exception)
+    deletes the temporary file.
+    """
+
+    def __init__(self, output_path: str, sample_rate: int = DEFAULT_SAMPLE_RATE):
+        self.output_path = output_path
+        self.temp_path = f"{output_path}.part.wav"
+        self.sample_rate = sample_rate
+        self.bytes_written = 0
+        self._wav = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+
+    def write(self, data: bytes):
+        if self._wav is None:
+            self._wav = wave.open(self.temp_path, 'wb')
+            self._wav.setnchannels(1)
+            self._wav.setsampwidth(2)
+            self._wav.setframerate(self.sample_rate)
+        self._wav.writeframes(data)
+        self.bytes_written += len(data)
+
+    def close(self) -> str:
+        """Finishes the WAV header and returns the temporary file's path."""
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+        return self.temp_path
+
+    def commit(self, path: str | None = None):
+        """Atomically moves the finished WAV (or an encoded `path`) to output_path."""
+        self.close()
+        os.replace(path or self.temp_path, self.output_path)
+        if path and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def abort(self):
+        self.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+async def _run_turn(pooled: PooledSession, prompt_text: str, timings: dict, sink) -> int:
+    """
+    Sends one user turn on an open session and writes each audio chunk to
+    `sink` as it arrives, until the server marks the turn complete.
+    Returns the number of PCM bytes received.
+    """
+    session = pooled.session
+    sent = time.perf_counter()
+    await session.send_client_content(
+        turns=Content(role="user", parts=[Part(text=prompt_text)])
+    )
+
+    audio_bytes = 0
+    # receive() ends after the message carrying turn_complete, which leaves
+    # the session ready for the next turn.
+    async for message in session.receive():
+        if message.go_away:
+            pooled.healthy = False  # Server is about to drop this session
+        server_content = message.server_content
+        if server_content and server_content.model_turn and server_content.model_turn.parts:
+            for part in server_content.model_turn.parts:
+                if part.inline_data:
+                    if not audio_bytes:
+                        timings['first_chunk_s'] = time.perf_counter() - sent
+                    audio_bytes += len(part.inline_data.data)
+                    sink.write(part.inline_data.data)
+    timings['generate_s'] = time.perf_counter() - sent
+    timings['audio_bytes'] = audio_bytes
+    return audio_bytes
+
+
+async def stream_audio(prompt_text: str, sink, timings: dict | None = None,
+                       pool: LiveSessionPool | None = None,
+                       live_config: LiveConnectConfig | None = None,
+                       session_starts: TokenBucket | None = None):
+    """
+    Connects to the Gemini API with a given prompt and writes the audio to
+    `sink` (any object with a `write(bytes)` method, e.g. WavFileSink) chunk
+    by chunk. Errors are raised so callers can decide whether to retry; a
+    turn with no audio raises EmptyAudioError.
+
+    With a `pool`, the turn runs on a pooled session (opened with the pool's
+    config) instead of a fresh connection opened with `live_config`, which
+    defaults to the module-level `config`. That fresh connection takes a
+    token from `session_starts`, if given; the pool holds its own.
+
+    If a `timings` dict is given, it is filled with the seconds spent
+    connecting (`connect_s`, near zero for a reused pooled session), until the
+    first audio chunk arrived (`first_chunk_s`, measured from when the prompt
+    was sent), generating the whole turn (`generate_s`) and the number of PCM
+    bytes received (`audio_bytes`).
+    """
+    if timings is None:
+        timings = {}
+    if not client:
+        raise RuntimeError("API client is not initialized. Cannot fetch audio.")
+
+    started = time.perf_counter()
+    if pool is None:
+        if session_starts:
+            await session_starts.acquire()
+        async with client.aio.live.connect(model=MODEL_NAME, config=live_config or config) as session:
+            timings['connect_s'] = time.perf_counter() - started
+            audio_bytes = await _run_turn(PooledSession(None, session), prompt_text, timings, sink)
+    else:
+        async with pool.session() as pooled:
+            timings['connect_s'] = time.perf_counter() - started
+            audio_bytes = await _run_turn(pooled, prompt_text, timings, sink)
+
+    if not audio_bytes:
+        raise EmptyAudioError("API returned no audio")
+
+
+async def request_audio(prompt_text: str, timings: dict | None = None,
+                        pool: LiveSessionPool | None = None,
+                        live_config: LiveConnectConfig | None = None) -> np.ndarray:
+    """
+    Like stream_audio, but collects the whole turn in memory and returns it
+    as a NumPy array.
+    """
+    sink = ArraySink()
+    await stream_audio(prompt_text, sink, timings, pool, live_config)
+    return sink.to_array()
+
+
+async def fetch_audio_data(prompt_text: str, timings: dict | None = None) -> np.ndarray | None:
+    """
+    Connects to the Gemini API with a given prompt and fetches the audio.
+    Returns a NumPy array of the audio data on success, or None on failure.
+    See request_audio for the contents of `timings`.
+    """
+    try:
+        return await request_audio(prompt_text, timings)
+    except EmptyAudioError:
+        return None
     except Exception as e:
         print(f"An exception occurred during the API call: {e}")
         return None
 
+# --- AUDIO ENCODING ---
+
+def output_path_for_format(output_path: str, output_format: str) -> str:
+    """Swaps the extension of `output_path` for the one `output_format` uses."""
+    return os.path.splitext(output_path)[0] + OUTPUT_FORMATS[output_format][0]
+
+
+ENCODE_BLOCK_FRAMES = 64 * 1024  # Frames read from the source WAV per encoder step
+
+
+def _mp3_compression_level(samplerate: int, bitrate: str = MP3_BITRATE) -> float:
+    """
+    Converts a bitrate like "64k" to the compression level libsndfile maps
+    linearly onto the MPEG bitrate range for `samplerate` in constant mode.
+    """
+    lower, upper = (32, 320) if samplerate >= 32000 else (8, 160) if samplerate >= 16000 else (8, 64)
+    kbps = min(max(int(bitrate.rstrip('k')), lower), upper)
+    return (upper - kbps) / (upper - lower)
+
+
+def encode_wav_file(source_path: str, output_path: str, output_format: str = DEFAULT_OUTPUT_FORMAT):
+    """
+    Encodes a 16-bit mono WAV file into `output_path` in the given format.
+
+    With soundfile installed the source is streamed through libsndfile in
+    ENCODE_BLOCK_FRAMES blocks, in-process and with bounded memory. MP3 is
+    written at a constant MP3_BITRATE, as with ffmpeg. Without soundfile, or
+    with a libsndfile or soundfile too old for that, this falls back to pydub,
+    which spawns ffmpeg for every file.
+    """
+    _, sf_format, sf_subtype, ffmpeg_format = OUTPUT_FORMATS[output_format]
+    if soundfile is not None and sf_format in soundfile.available_formats():
+        info = soundfile.info(source_path)
+        options = {}
+        if output_format == "mp3":
+            options = {'bitrate_mode': 'CONSTANT', 'compression_level': _mp3_compression_level(info.samplerate)}
+        try:
+            with soundfile.SoundFile(output_path, 'w', samplerate=info.samplerate, channels=info.channels,
+                                     format=sf_format, subtype=sf_subtype, **options) as out:
+                for block in soundfile.blocks(source_path, blocksize=ENCODE_BLOCK_FRAMES, dtype='int16'):
+                    out.write(block)
+            return
+        except (TypeError, RuntimeError):  # LibsndfileError is a RuntimeError
+            pass  # No bitrate control in this soundfile/libsndfile; let ffmpeg do it
+    audio_segment = AudioSegment.from_wav(source_path)
+    audio_segment.export(output_path, format=ffmpeg_format,
+                         bitrate=MP3_BITRATE if output_format == "mp3" else None)
+
+
+class AudioEncoderPool:
+    """
+    Long-lived process pool for encoding, so CPU-bound encoding never runs
+    on the event loop that drives the live sessions. Outputs are written to
+    a temporary name and only renamed into place once complete.
+    """
+
+    def __init__(self, workers: int = ENCODER_WORKERS, output_format: str = DEFAULT_OUTPUT_FORMAT):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format '{output_format}'. Choose from {sorted(OUTPUT_FORMATS)}.")
+        self.output_format = output_format
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+
+    async def finish(self, sink: WavFileSink):
+        """Encodes a completed sink's WAV and atomically publishes the result."""
+        source_path = sink.close()
+        if self.output_format == "wav":
+            sink.commit()  # Already in the target format; just rename it
+            return
+        encoded_path = f"{sink.output_path}.part"
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self._executor, encode_wav_file, source_path, encoded_path, self.output_format
+            )
+            sink.commit(encoded_path)
+        finally:
+            if os.path.exists(encoded_path):
+                os.remove(encoded_path)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+# --- SYNTHESIS CACHE ---
+
+class SynthesisCache:
+    """
+    Content-addressed store of encoded audio, keyed by a hash of (model,
+    voice, system instruction, text, output format).
+
+    Outputs are materialised from the cache by hardlink, or by copy across
+    filesystems. Identical lines that are generated at the same time are
+    deduplicated: the first one claims the key and the rest wait as
+    followers until it finishes. Entries are evicted least recently used
+    first once the cache grows past `max_bytes`. Recency is tracked in the
+    entries' access times: their modification times are left alone, because
+    a hardlinked entry shares them with an output that mtime-keyed tools watch.
+    """
+
+    def __init__(self, cache_dir: str, system_instruction: str | None, output_format: str,
+                 max_bytes: int = CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.system_instruction = system_instruction or ""
+        self.output_format = output_format
+        self.extension = OUTPUT_FORMATS[output_format][0]
+        self.max_bytes = max_bytes
+        self._in_flight = {}  # key -> output paths waiting on the current attempt
+
+    def key(self, text: str) -> str:
+        material = json.dumps([MODEL_NAME, VOICE_NAME, self.system_instruction, text, self.output_format])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + self.extension)
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self.path_for(key))
+
+    @staticmethod
+    def _link_or_copy(source: str, destination: str):
+        temp_path = f"{destination}.{os.getpid()}.part"  # Unique per process when sharded
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+        os.replace(temp_path, destination)
+
+    @staticmethod
+    def _mark_used(entry: str):
+        """Sets the entry's access time to now for LRU eviction, keeping its mtime."""
+        os.utime(entry, ns=(time.time_ns(), os.stat(entry).st_mtime_ns))
+
+    def store(self, key: str, output_path: str):
+        """Adds a freshly generated output to the cache."""
+        entry = self.path_for(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        self._link_or_copy(output_path, entry)
+        self._mark_used(entry)
+
+    def materialize(self, key: str, output_path: str) -> bool:
+        """
+        Makes `output_path` hold the cached audio for `key`. Returns False if
+        it already did (same inode, or identical bytes for a copied entry).
+        """
+        entry = self.path_for(key)
+        self._mark_used(entry)
+        if os.path.exists(output_path):
+            if os.path.samefile(entry, output_path) or filecmp.cmp(entry, output_path, shallow=False):
+                return False
+        self._link_or_copy(entry, output_path)
+        return True
+
+    def claim(self, key: str, output_path: str) -> bool:
+        """
+        Returns True if the caller should generate `key`. Otherwise the same
+        audio is already being generated and `output_path` is attached to it.
+        """
+        if key in self._in_flight:
+            self._in_flight[key].append(output_path)
+            return False
+        self._in_flight[key] = []
+        return True
+
+    def release(self, key: str, success: bool, source_path: str | None = None) -> list:
+        """
+        Ends the attempt that claimed `key`. On success every follower gets a
+        copy of `source_path` (the owner's output) and is returned. On failure
+        the first follower (if any) is returned as the new owner of the key,
+        to be generated in turn. The key is no longer in flight either way,
+        even if copying to a follower raises.
+        """
+        followers = self._in_flight.pop(key, [])
+        if success:
+            for output_path in followers:
+                self._link_or_copy(source_path or self.path_for(key), output_path)
+            return followers
+        if followers:
+            self._in_flight[key] = followers[1:]
+            return followers[:1]
+        return []
+
+    def evict(self) -> int:
+        """Deletes least recently used entries until under max_bytes. Returns bytes freed."""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+        freed = 0
+        for _, size, path in sorted(entries):
+            if total - freed <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Another shard evicted it first
+            freed += size
+        return freed
+
+
 # --- HIGH-LEVEL BATCH PROCESSING LOGIC ---
 
 LineProcessorFn = Callable[[str, int], Optional[Tuple[str, str]]]
 
-async def _process_task(prompt: str, output_path: str, semaphore, pbar_stats):
-    """Internal worker to process a single audio generation task."""
+TIMED_PHASES = ("connect_s", "first_chunk_s", "generate_s", "export_s", "total_s")
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class RequestMetrics:
+    """
+    Collects per-request timings, appends each one to a JSON-lines file and
+    prints a p50/p95/p99 summary per phase at the end of a run. Percentiles
+    come from a uniform reservoir sample of METRICS_SAMPLE_SIZE timings per
+    phase, so memory doesn't grow with the number of requests.
+    """
+
+    def __init__(self, metrics_file: str | None = METRICS_FILE):
+        self._file = open(metrics_file, 'a', encoding='utf-8') if metrics_file else None
+        self.count = 0
+        self.audio_bytes = 0
+        self.samples = {phase: [] for phase in TIMED_PHASES}
+        self.seen = dict.fromkeys(TIMED_PHASES, 0)
+        self.started = time.perf_counter()
+
+    @classmethod
+    def load(cls, metrics_files: list, since: float = 0.0) -> "RequestMetrics":
+        """
+        Reads records written at or after the `since` timestamp from several
+        JSON-lines files, e.g. one per shard, for a combined summary.
+        """
+        metrics = cls(None)
+        for path in metrics_files:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for entry in map(json.loads, f):
+                    if entry['ts'] >= since:
+                        metrics._add(entry)
+        if since:
+            metrics.started -= time.time() - since
+        return metrics
+
+    def record(self, output_path: str, status: str, timings: dict):
+        entry = {"output_path": output_path, "status": status, "ts": time.time(), **timings}
+        self._add(entry)
+        if self._file:
+            self._file.write(json.dumps(entry) + "\n")
+
+    def _add(self, entry: dict):
+        self.count += 1
+        self.audio_bytes += entry.get('audio_bytes', 0)
+        for phase in TIMED_PHASES:
+            if phase not in entry:
+                continue
+            self.seen[phase] += 1
+            sample = self.samples[phase]
+            if len(sample) < METRICS_SAMPLE_SIZE:
+                sample.append(entry[phase])
+            else:
+                slot = random.randrange(self.seen[phase])  # Reservoir sampling (Algorithm R)
+                if slot < METRICS_SAMPLE_SIZE:
+                    sample[slot] = entry[phase]
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def print_summary(self):
+        if not self.count:
+            return
+        elapsed = time.perf_counter() - self.started
+        print("\n--- Latency Summary (seconds) ---")
+        print(f"{'phase':<14}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+        for phase in TIMED_PHASES:
+            values = sorted(self.samples[phase])
+            if values:
+                print(f"{phase:<14}{self.seen[phase]:>7}{_percentile(values, 50):>9.2f}"
+                      f"{_percentile(values, 95):>9.2f}{_percentile(values, 99):>9.2f}")
+        print(f"Audio received: {self.audio_bytes / 1e6:.1f} MB "
+              f"({self.audio_bytes / max(elapsed, 1e-6) / 1e3:.1f} kB/s, "
+              f"{self.count / max(elapsed, 1e-6):.2f} requests/s)")
+        print("---------------------------------")
+
+
+async def _process_task(prompt: str, output_path: str, attempt: int, scheduler: LiveRequestScheduler,
+                        pbar_stats, encoder: AudioEncoderPool, metrics: RequestMetrics | None = None,
+                        pool: LiveSessionPool | None = None,
+                        live_config: LiveConnectConfig | None = None,
+                        cache: SynthesisCache | None = None,
+                        session_starts: TokenBucket | None = None) -> Tuple[str, float | None]:
+    """
+    Internal worker to make one attempt at a single audio generation task.
+    Returns ("success", None) or ("failed", None) once the task is finished,
+    or ("retry", delay) with the backoff after which it should be queued again.
+    Audio is streamed to a temporary WAV as it arrives, and the session slot
+    is released before that file is handed to the encoder.
+    """
     identifier = output_path
-    async with semaphore:
+    timings = {'attempt': attempt}
+    status = "failed"
+    started = time.perf_counter()
+    sink = WavFileSink(output_path)
+    try:
+        await scheduler.acquire()
         pbar_stats['active'] += 1
         try:
-            audio_array = await fetch_audio_data(prompt)
-            if audio_array is not None:
-                # Convert numpy array to an AudioSegment
-                audio_segment = AudioSegment(
-                    audio_array.tobytes(),
-                    frame_rate=DEFAULT_SAMPLE_RATE,
-                    sample_width=audio_array.dtype.itemsize,
-                    channels=1
-                )
-                # Export as MP3
-                audio_segment.export(output_path, format="mp3", bitrate="64k")
-                pbar_stats['success'] += 1
-            else:
-                tqdm.write(f"✗ FAILED: {identifier} (API returned None)")
-                pbar_stats['failed'] += 1
+            await stream_audio(prompt, sink, timings, pool, live_config, session_starts)
+            scheduler.on_success()
         except Exception as e:
-            tqdm.write(f"✗ UNEXPECTED FAILED: {identifier}. Error: {e}")
-            pbar_stats['failed'] += 1
+            retryable, throttled = classify_error(e)
+            if throttled:
+                scheduler.on_throttled()
+            if not retryable or attempt >= scheduler.max_attempts:
+                tqdm.write(f"✗ FAILED: {identifier} after {attempt} attempt(s). Error: {e}")
+                pbar_stats['failed'] += 1
+                return "failed", None
+            status = "throttled" if throttled else "retry"
+            pbar_stats['retries'] += 1
+            return "retry", scheduler.backoff(attempt)
         finally:
             pbar_stats['active'] -= 1
+            pbar_stats['limit'] = int(scheduler.limit)
+            await scheduler.release()
+
+        export_started = time.perf_counter()
+        try:
+            await encoder.finish(sink)
+        except Exception as e:
+            tqdm.write(f"✗ FAILED: {identifier} (encoding failed). Error: {e}")
+            pbar_stats['failed'] += 1
+            return "failed", None
+        timings['export_s'] = time.perf_counter() - export_started
+        status = "success"
+        pbar_stats['success'] += 1
+        if cache:
+            try:
+                cache.store(cache.key(prompt), output_path)
+            except OSError as e:
+                tqdm.write(f"⚠ Could not cache {identifier}: {e}")  # The output itself is fine
+        return "success", None
+    finally:
+        if status != "success":
+            sink.abort()  # Never leave a half-written temp file behind
+        if metrics:
+            timings['total_s'] = time.perf_counter() - started
+            metrics.record(output_path, status, timings)
+
+
+def count_lines(path: str) -> int:
+    """Counts newline-terminated lines by scanning raw bytes, without decoding."""
+    count = 0
+    last = b"\n"
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            count += block.count(b"\n")
+            last = block[-1:]
+    return count + (last != b"\n")
+
+
+def in_shard(output_path: str, shard: Tuple[int, int] | None) -> bool:
+    """
+    True if `output_path` belongs to shard (index, count). The CRC32 of the
+    path is stable across processes and hosts, unlike Python's hash().
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(output_path.encode('utf-8')) % count == index
+
+
+def _advance(pbar, pbar_stats, n: int = 1):
+    """Moves the progress bar on by `n` lines, mirrored in pbar_stats['done']."""
+    pbar_stats['done'] += n
+    pbar.update(n)
+
+
+async def _produce_tasks(input_file: str, system_prompt: str, line_processor_fn: LineProcessorFn,
+                         inline_system_prompt: bool, output_format: str, queue: asyncio.Queue,
+                         pbar, pbar_stats, cache: SynthesisCache | None = None,
+                         regenerate_stale: bool = False, shard: Tuple[int, int] | None = None):
+    """
+    Reads the input file lazily and feeds (prompt, output_path, attempt)
+    items into the bounded queue, so only the queued lines are held in memory.
+    Lines that are skipped, already have audio or are served from the cache
+    only advance the progress bar. With `regenerate_stale`, an existing output
+    that doesn't match the cache entry for its current text is regenerated.
+    Lines whose output belongs to another `shard` are passed over; lines with
+    no output at all are counted by shard 0 only.
+    """
+    created_dirs = set()
+    with open(input_file, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            processed = line_processor_fn(line, i)
+            if not processed:
+                # No output path to shard on, so only the first shard counts it
+                if shard is None or shard[0] == 0:
+                    pbar_stats['skipped'] += 1
+                    _advance(pbar, pbar_stats)
+                continue
+
+            text_for_prompt, output_path = processed
+            output_path = output_path_for_format(output_path, output_format)
+            if not in_shard(output_path, shard):
+                continue  # Another shard's line; not counted on this shard's bar
+            if inline_system_prompt:
+                text_for_prompt = f"{system_prompt}{text_for_prompt}"
+            key = cache.key(text_for_prompt) if cache else None
+            exists = os.path.exists(output_path)
+            if exists and not (cache and regenerate_stale):
+                pbar_stats['skipped'] += 1
+                _advance(pbar, pbar_stats)
+                continue
+
+            # Ensure the parent directory exists
+            output_dir = os.path.dirname(output_path)
+            if output_dir and output_dir not in created_dirs:
+                os.makedirs(output_dir, exist_ok=True)
+                created_dirs.add(output_dir)
+
+            if cache and cache.contains(key):
+                pbar_stats['cached' if cache.materialize(key, output_path) else 'skipped'] += 1
+                _advance(pbar, pbar_stats)
+                continue
+            if cache and not cache.claim(key, output_path):
+                pbar_stats['deduplicated'] += 1
+                continue  # Counted on the bar when the identical line finishes
+            pbar_stats['queued'] += 1
+            await queue.put((text_for_prompt, output_path, 1))
+
+
+async def _requeue_later(queue: asyncio.Queue, item: tuple, delay: float):
+    """
+    Puts a retried item back on the queue after its backoff, then marks the
+    original attempt done. Doing it in that order keeps queue.join() from
+    returning while a retry is still waiting.
+    """
+    try:
+        await asyncio.sleep(delay)
+        await queue.put(item)
+    finally:
+        queue.task_done()
+
+
+def _schedule_requeue(queue: asyncio.Queue, item: tuple, delay: float, retry_tasks: set):
+    retry = asyncio.create_task(_requeue_later(queue, item, delay))
+    retry_tasks.add(retry)
+    retry.add_done_callback(retry_tasks.discard)
+
+
+async def _consume_tasks(queue: asyncio.Queue, pbar, retry_tasks: set, process_kwargs: dict):
+    """Worker loop: takes items off the queue until it is cancelled."""
+    cache = process_kwargs['cache']
+    while True:
+        prompt, output_path, attempt = await queue.get()
+        try:
+            status, delay = await _process_task(prompt, output_path, attempt, **process_kwargs)
+        except asyncio.CancelledError:
+            queue.task_done()
+            raise
+        except Exception as e:
+            # Keep the worker alive and let the failure path below release the cache key
+            tqdm.write(f"✗ FAILED: {output_path}. Error: {e}")
+            process_kwargs['pbar_stats']['failed'] += 1
+            status, delay = "failed", None
+        if status == "retry":
+            _schedule_requeue(queue, (prompt, output_path, attempt + 1), delay, retry_tasks)
+            continue
+
+        _advance(pbar, process_kwargs['pbar_stats'])
+        pbar.set_postfix(process_kwargs['pbar_stats'], refresh=False)
+        try:
+            followers = cache.release(cache.key(prompt), status == "success", output_path) if cache else []
+        except OSError as e:
+            tqdm.write(f"✗ FAILED: could not copy {output_path} to its duplicate lines. Error: {e}")
+            followers = []
+        if status == "success":
+            _advance(pbar, process_kwargs['pbar_stats'], len(followers))
+        elif followers:
+            # The identical line waiting on this one now gets its own attempts.
+            _schedule_requeue(queue, (prompt, followers[0], 1), 0, retry_tasks)
+            continue
+        queue.task_done()
+
+
+async def _report_progress(progress_fn: Callable[[dict], None], pbar_stats: dict):
+    """Hands a snapshot of the counters to progress_fn every PROGRESS_INTERVAL seconds."""
+    while True:
+        progress_fn(dict(pbar_stats))
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+
+def print_generation_summary(pbar_stats: dict, concurrency_limit: int, sessions_opened: int | None = None,
+                             cache_freed: int = 0):
+    """Prints the end-of-run counters; also used to print merged shard totals."""
+    print("\n--- Generation Summary ---")
+    print(f"↷ Skipped:    {pbar_stats['skipped']}")
+    print(f"⧉ From cache: {pbar_stats['cached']} (+{pbar_stats['deduplicated']} deduplicated in flight)")
+    print(f"✓ Successful: {pbar_stats['success']}")
+    print(f"✗ Failed:     {pbar_stats['failed']}")
+    print(f"↻ Retries:    {pbar_stats['retries']}")
+    print(f"Final session limit: {pbar_stats['limit']}/{concurrency_limit}")
+    if sessions_opened is not None:
+        print(f"Sessions opened: {sessions_opened}")
+    if cache_freed:
+        print(f"Cache trimmed by {cache_freed / 1e6:.1f} MB")
+    print("--------------------------")
+
 
 async def process_text_file_concurrently(
     input_file: str,
     system_prompt: str,
     line_processor_fn: LineProcessorFn,
     concurrency_limit: int = 100,
-):
+    metrics_file: str | None = METRICS_FILE,
+    requests_per_minute: float | None = None,
+    max_attempts: int = MAX_ATTEMPTS,
+    session_pool_size: int | None = None,
+    inline_system_prompt: bool = False,
+    precount: bool = True,
+    output_format: str = DEFAULT_OUTPUT_FORMAT,
+    encoder_workers: int = ENCODER_WORKERS,
+    cache_dir: str | None = CACHE_DIR,
+    cache_max_bytes: int = CACHE_MAX_BYTES,
+    regenerate_stale: bool = False,
+    shard: Tuple[int, int] | None = None,
+    progress_fn: Callable[[dict], None] | None = None,
+    verbose: bool = True,
+) -> dict | None:
     """
     Reads lines from an input file and generates audio concurrently.
 
+    Lines are streamed: a producer reads the file lazily into a bounded
+    queue that a fixed pool of `concurrency_limit` workers drains, so memory
+    stays flat regardless of the input size and the first request starts as
+    soon as the first line is read.
+
     Args:
         input_file: Path to the text file to process.
-        system_prompt: The base prompt to prepend to each line's text.
+        system_prompt: Instructions for every line, sent once per session as
+                       the system instruction.
         line_processor_fn: A callback function that takes (line, index) and
                            returns a tuple of (text_for_prompt, output_filepath).
                            It can return None to skip a line.
+        concurrency_limit: Maximum number of concurrent live sessions. The
+                           scheduler shrinks below this while throttled.
+        metrics_file: JSON-lines file to append per-request timings to,
+                      or None to only print the latency summary.
+        requests_per_minute: Budget of new live sessions per minute, or None for
+                             no limit. Turns on pooled sessions that are already
+                             open don't count against it.
+        max_attempts: How many times a line is tried before it is reported failed.
+        session_pool_size: Number of live sessions kept open and reused across
+                           lines. Defaults to concurrency_limit; 0 opens a new
+                           session for every line.
+        inline_system_prompt: Prepend system_prompt to every line's text
+                              instead, as earlier versions did.
+        precount: Count the input's lines up front (a raw byte scan) to give
+                  the progress bar a total. False shows a running count only.
+        output_format: One of OUTPUT_FORMATS ("mp3", "opus", "flac", "wav").
+                       The extension of each output path is replaced to match.
+        encoder_workers: Size of the encoder process pool.
+        cache_dir: Directory of the content-addressed synthesis cache, or None
+                   to disable it. Lines whose (model, voice, system prompt,
+                   text, format) were generated before are copied from it.
+        cache_max_bytes: Size the cache is trimmed to (LRU) after the run.
+        regenerate_stale: Regenerate existing outputs that don't match the
+                          cache entry for their current text and settings.
+        shard: (index, count) to only process lines whose output path hashes
+               into this shard, so several processes or hosts can split a run.
+        progress_fn: Called about every PROGRESS_INTERVAL seconds, and once at
+                     the end, with a copy of the run's counters.
+        verbose: Print the header, progress bar and summaries. A supervisor
+                 merging several shards turns this off.
+
+    Returns the run's final counters, or None if the run could not start.
     """
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-    except FileNotFoundError:
+    if not os.path.exists(input_file):
         print(f"Error: Input file not found at '{input_file}'")
         return
+    # A shard's share of the lines isn't known until they are hashed.
+    total_lines = count_lines(input_file) if precount and shard is None else None
 
-    tasks_to_run = []
-    dirs_to_create = set()
-    for i, line in enumerate(lines):
-        processed = line_processor_fn(line, i)
-        if not processed:
-            continue
-        
-        text_for_prompt, output_path = processed
-        if not os.path.exists(output_path):
-            full_prompt = f"{system_prompt}{text_for_prompt}"
-            tasks_to_run.append((full_prompt, output_path))
-            # Ensure the parent directory exists
-            output_dir = os.path.dirname(output_path)
-            if output_dir:
-                dirs_to_create.add(output_dir)
-
-    if not tasks_to_run:
-        print("All audio files already exist. Nothing to do.")
+    if output_format not in OUTPUT_FORMATS:
+        print(f"Error: Unknown output format '{output_format}'. Choose from {sorted(OUTPUT_FORMATS)}.")
         return
-
-    for directory in dirs_to_create:
-        os.makedirs(directory, exist_ok=True)
-
-    print(f"Total lines: {len(lines)} | To generate: {len(tasks_to_run)}")
-    print(f"Concurrency: {concurrency_limit}")
-    
-    semaphore = asyncio.Semaphore(concurrency_limit)
-    pbar_stats = {'active': 0, 'success': 0, 'failed': 0}
+    if session_pool_size is None:
+        session_pool_size = concurrency_limit
+    if verbose:
+        print(f"Total lines: {total_lines if total_lines is not None else 'not counted'}"
+              + (f" | Shard: {shard[0]}/{shard[1]}" if shard else ""))
+        print(f"Concurrency: {concurrency_limit} | Requests/min: {requests_per_minute or 'unlimited'} "
+              f"| Session pool: {session_pool_size or 'off'}")
+        print(f"Output format: {output_format} | Encoder processes: {encoder_workers}")
     
-    tasks = [_process_task(prompt, path, semaphore, pbar_stats) for prompt, path in tasks_to_run]
+    scheduler = LiveRequestScheduler(concurrency_limit, max_attempts)
+    session_starts = TokenBucket(requests_per_minute) if requests_per_minute else None
+    pbar_stats = {'done': 0, 'active': 0, 'queued': 0, 'skipped': 0, 'cached': 0, 'deduplicated': 0,
+                  'success': 0, 'failed': 0, 'retries': 0, 'limit': concurrency_limit}
+    metrics = RequestMetrics(metrics_file)
+    live_config = build_live_config(None if inline_system_prompt else system_prompt)
+    pool = LiveSessionPool(session_pool_size, live_config, session_starts=session_starts) if session_pool_size else None
+    encoder = AudioEncoderPool(encoder_workers, output_format)
+    cache = SynthesisCache(cache_dir, None if inline_system_prompt else system_prompt,
+                           output_format, cache_max_bytes) if cache_dir else None
+    queue = asyncio.Queue(maxsize=2 * concurrency_limit)
+    workers = []
+    retry_tasks = set()
+    reporter = asyncio.create_task(_report_progress(progress_fn, pbar_stats)) if progress_fn else None
     
     try:
-        with tqdm(total=len(tasks_to_run), desc="Generating Audio", unit="file") as pbar:
-            for future in asyncio.as_completed(tasks):
-                pbar.set_postfix(pbar_stats, refresh=True)
-                await future
-                pbar.update(1)
+        with tqdm(total=total_lines, desc="Generating Audio", unit="line", disable=not verbose) as pbar:
+            process_kwargs = dict(scheduler=scheduler, pbar_stats=pbar_stats, encoder=encoder,
+                                  metrics=metrics, pool=pool, live_config=live_config, cache=cache,
+                                  session_starts=session_starts)
+            workers = [asyncio.create_task(_consume_tasks(queue, pbar, retry_tasks, process_kwargs))
+                       for _ in range(concurrency_limit)]
+            await _produce_tasks(input_file, system_prompt, line_processor_fn,
+                                 inline_system_prompt, output_format, queue, pbar, pbar_stats,
+                                 cache, regenerate_stale, shard)
+            await queue.join()
             pbar.set_postfix(pbar_stats, refresh=True)
+        if verbose and pbar_stats['queued'] == 0 and pbar_stats['cached'] == 0:
+            print("All audio files already exist. Nothing to do.")
 
     except KeyboardInterrupt:
         print("\nInterrupted by user. Shutting down gracefully...")
     finally:
-        print("\n--- Generation Summary ---")
-        print(f"✓ Successful: {pbar_stats['success']}")
-        print(f"✗ Failed:     {pbar_stats['failed']}")
-        print("--------------------------")
+        for task in [*workers, *retry_tasks]:
+            task.cancel()
+        await asyncio.gather(*workers, *retry_tasks, return_exceptions=True)
+        encoder.close()
+        if pool:
+            await pool.close()
+        freed = cache.evict() if cache else 0
+        metrics.close()
+        if reporter:
+            reporter.cancel()
+            progress_fn(dict(pbar_stats))
+        if verbose:
+            print_generation_summary(pbar_stats, concurrency_limit, pool.opened_total if pool else None, freed)
+            metrics.print_summary()
+    return pbar_stats
 
 # --- Self-Test Block ---
 async def _test_fetch():
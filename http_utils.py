@@ -0,0 +1,66 @@
+import time
+import random
+import hashlib
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+
+# --- Configuration ---
+HASH_BLOCK_SIZE = 64 * 1024  # Bytes read per step when hashing a file
+BACKOFF_BASE = 1.0  # Default seconds before the first retry
+BACKOFF_CAP = 60.0  # Default longest wait between two attempts
+# ---------------------
+
+_thread_local = threading.local()
+
+
+def get_session():
+    """
+    Returns a requests.Session private to the calling worker thread.
+    Each session keeps its keep-alive connection open, so only the first
+    request a worker makes to a host pays for the TCP/TLS handshake.
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _thread_local.session = session
+    return session
+
+
+def parse_retry_after(value):
+    """Converts a Retry-After header (seconds or an HTTP date) to seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_delay(attempt, retry_after=None, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Exponential backoff with full jitter for the given (1-based) attempt.
+    A server-supplied Retry-After always wins if it asks for a longer wait.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def file_md5(filepath):
+    """Returns the hex MD5 of a file, read in HASH_BLOCK_SIZE blocks."""
+    digest = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
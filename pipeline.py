@@ -0,0 +1,206 @@
+import os
+import time
+import queue
+import argparse
+import functools
+import threading
+from collections import namedtuple
+import archive_upload
+import concatenate_audio
+import download_quran
+from state_db import StateDB
+
+# --- Configuration ---
+PIPELINE_STATE_PATH = ".pipeline_state.sqlite"
+QUEUE_SIZE = 4  # Items that may wait in front of a stage before the one upstream blocks
+CONCATENATED_DIR = "Quran_Concatenated"
+CONCATENATE_CONCURRENCY = 4
+UPLOAD_CONCURRENCY = 2
+# ---------------------
+
+# One step of the pipeline. `fn(item)` does the work for a single item and
+# returns False (or raises) on failure; `concurrency` is its worker count.
+Stage = namedtuple("Stage", ["name", "fn", "concurrency"])
+
+_DONE = object()  # Queue sentinel: no more items for this stage
+
+
+class PipelineState(StateDB):
+    """
+    Which stages have finished for which items, so an interrupted run resumes
+    where it stopped. Stage workers share one connection, guarded by a lock.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS stages (
+               item TEXT NOT NULL,
+               stage TEXT NOT NULL,
+               status TEXT NOT NULL,
+               error TEXT,
+               finished_at REAL NOT NULL,
+               PRIMARY KEY (item, stage)
+           )""",
+    )
+
+    def __init__(self, path=PIPELINE_STATE_PATH):
+        super().__init__(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def is_done(self, item, stage):
+        with self.lock:
+            row = self.conn.execute("SELECT status FROM stages WHERE item = ? AND stage = ?", (str(item), stage)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def record(self, item, stage, status, error=None):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)",
+                              (str(item), stage, status, error, time.time()))
+            self.conn.commit()
+
+
+def run_pipeline(items, stages, state_path=PIPELINE_STATE_PATH, queue_size=QUEUE_SIZE):
+    """
+    Streams `items` through `stages`. Each stage has its own worker threads
+    and a bounded input queue, so an item moves on as soon as a stage finishes
+    it and a slow stage holds back its upstream instead of letting work pile
+    up. Stages already recorded as done for an item are skipped. An item that
+    fails a stage stops there and is retried on the next run.
+    Returns (completed items, {item: (stage, error)}).
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    completed, failed = [], {}
+    results_lock = threading.Lock()
+
+    with PipelineState(state_path) as state:
+        def worker(index):
+            stage = stages[index]
+            while (item := queues[index].get()) is not _DONE:
+                if not state.is_done(item, stage.name):
+                    try:
+                        ok = stage.fn(item) is not False
+                        error = None if ok else "stage reported failure"
+                    except Exception as e:
+                        ok, error = False, str(e)
+                    state.record(item, stage.name, 'done' if ok else 'failed', error)
+                    if not ok:
+                        print(f"✗ {stage.name} failed for {item}: {error}")
+                        with results_lock:
+                            failed[item] = (stage.name, error)
+                        continue
+                if index + 1 < len(stages):
+                    queues[index + 1].put(item)
+                else:
+                    with results_lock:
+                        completed.append(item)
+
+        threads = [
+            [threading.Thread(target=worker, args=(index,), name=f"{stage.name}-{n}", daemon=True)
+             for n in range(stage.concurrency)]
+            for index, stage in enumerate(stages)
+        ]
+        for stage_threads in threads:
+            for thread in stage_threads:
+                thread.start()
+
+        for item in items:
+            queues[0].put(item)
+        # Shut the stages down in order: a stage's queue only gets its sentinels
+        # once every worker upstream of it has exited.
+        for index, stage in enumerate(stages):
+            for _ in range(stage.concurrency):
+                queues[index].put(_DONE)
+            for thread in threads[index]:
+                thread.join()
+
+    return completed, failed
+
+
+def surah_dir(surah_number):
+    return os.path.join(download_quran.OUTPUT_DIR, f"Surah_{surah_number:03d}")
+
+
+def concatenated_path(surah_number):
+    return os.path.join(CONCATENATED_DIR, f"Surah_{surah_number:03d}.mp3")
+
+
+def adopt_downloads():
+    """
+    Records files downloaded before the manifest existed, as download_quran_audio
+    does, so the download stage doesn't fetch them again.
+    """
+    with download_quran.DownloadManifest() as manifest:
+        if manifest.is_empty() and os.path.isdir(download_quran.OUTPUT_DIR):
+            adopted = download_quran.adopt_existing_files(manifest)
+            if adopted:
+                print(f"Recorded {adopted} previously downloaded files in the manifest.")
+
+
+def download_surah(surah_number, controller=None):
+    """
+    Downloads the surah's missing ayahs, recording them in the download manifest.
+    Pass the same `controller` for every surah so the concurrency it settled on
+    carries over instead of ramping up from scratch each time.
+    """
+    with download_quran.DownloadManifest() as manifest:
+        completed = manifest.completed_paths()
+        tasks = [task for task in download_quran.all_ayah_tasks([surah_number]) if task['filepath'] not in completed]
+        if not tasks:
+            return True
+        failed_downloads, _ = download_quran.run_download_scheduler(tasks, on_success=manifest.record, controller=controller)
+    return not failed_downloads
+
+
+def concatenate_surah(surah_number):
+    """Joins the surah's ayahs, in order, into one file."""
+    directory = surah_dir(surah_number)
+    paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.mp3'))
+    os.makedirs(CONCATENATED_DIR, exist_ok=True)
+    return concatenate_audio.concatenate_files(paths, concatenated_path(surah_number))
+
+
+def upload_surah(surah_number):
+    """Publishes the surah's ayahs and its joined file, skipping any already in sync."""
+    directory = surah_dir(surah_number)
+    paths = [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if archive_upload.should_publish(f)]
+    # The item's derive is queued once, after the whole run
+    return archive_upload.upload_paths(paths + [concatenated_path(surah_number)], derive=False)
+
+
+def parse_surahs(value):
+    """Parses '1-114' or '2,18,36' into a list of surah numbers."""
+    surahs = []
+    for part in value.split(','):
+        start, _, end = part.partition('-')
+        surahs.extend(range(int(start), int(end or start) + 1))
+    if any(not 1 <= surah <= 114 for surah in surahs):
+        raise argparse.ArgumentTypeError("surah numbers must be between 1 and 114")
+    return surahs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download, concatenate and upload surahs as a streaming pipeline.")
+    parser.add_argument("--surahs", type=parse_surahs, default=list(range(1, 115)), help="E.g. 1-114 or 2,18,36.")
+    parser.add_argument("--concatenate-workers", type=int, default=CONCATENATE_CONCURRENCY)
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_CONCURRENCY)
+    parser.add_argument("--no-upload", action="store_true", help="Stop after concatenation.")
+    args = parser.parse_args()
+
+    # One download worker: the scheduler inside it already runs an adaptive
+    # pool of connections, and the download manifest expects a single writer.
+    adopt_downloads()
+    controller = download_quran.ConcurrencyController()
+    stages = [
+        Stage("download", functools.partial(download_surah, controller=controller), 1),
+        Stage("concatenate", concatenate_surah, args.concatenate_workers),
+    ]
+    if not args.no_upload:
+        stages.append(Stage("upload", upload_surah, args.upload_workers))
+
+    start = time.monotonic()
+    completed, failed = run_pipeline(args.surahs, stages)
+    archive_upload.queue_deferred_derive()
+    print(f"\n{'='*60}")
+    print(f"Pipeline finished in {time.monotonic() - start:.1f}s: {len(completed)}/{len(args.surahs)} surahs completed.")
+    for item, (stage, error) in sorted(failed.items()):
+        print(f"  - Surah {item}: {stage} failed ({error})")
+    print(f"{'='*60}")
@@ -0,0 +1,32 @@
+import os
+import sqlite3
+
+
+class StateDB:
+    """
+    Base for the small SQLite files the scripts keep their progress in.
+    Subclasses list their CREATE TABLE statements in `schema`. Used as a
+    context manager, the connection is committed and closed on exit.
+    """
+
+    schema = ()
+
+    def __init__(self, path, check_same_thread=True):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=check_same_thread)
+        for statement in self.schema:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -1,15 +1,24 @@
 # input_tts.py
 
+import argparse
 import asyncio
+import multiprocessing
 import os
+import queue
+import time
+from tqdm import tqdm
 
 # Import the high-level batch processor
-from gemini_audio_client import process_text_file_concurrently
+from gemini_audio_client import (ENCODER_WORKERS, METRICS_FILE, RequestMetrics, count_lines,
+                                 print_generation_summary, process_text_file_concurrently)
 
 # --- APPLICATION-SPECIFIC CONFIGURATION ---
 INPUT_FILE = "input.txt"
 OUTPUT_DIR = "audio"
 CONCURRENCY_LIMIT = 250 # Can be adjusted based on need
+REQUESTS_PER_MINUTE = None # New live sessions per minute (the project's session quota), or None for no limit
+SESSION_POOL_SIZE = CONCURRENCY_LIMIT # Live sessions kept open and reused; 0 connects per line
+OUTPUT_FORMAT = "mp3" # One of "mp3", "opus", "flac" or "wav"
 
 SYSTEM_PROMPT = """
 **Objective:** To generate a high-quality, culturally and religiously resonant Malayalam audio narration from a given Malayalam text, specifically for a Muslim audience.
@@ -63,7 +72,7 @@ def process_quran_line(line: str, index: int):
     output_dir = f"{OUTPUT_DIR}/{sura}"
     output_path = f"{output_dir}/{ayah}.mp3"
 
-    # The first element is the text to be appended to the system prompt
+    # The first element is the text sent as the user turn
     # The second element is the full path to save the audio file
     return (arabic_text, output_path)
 
@@ -78,20 +87,119 @@ def process_simple_line(line: str, index: int):
 
     output_path = os.path.join(OUTPUT_DIR, f"{index + 1:03d}.mp3")
     
-    # The first element is the text to be appended to the system prompt
+    # The first element is the text sent as the user turn
     # The second element is the full path to save the audio file
     return (text, output_path)
 
-async def main():
-    """Main function to start the audio generation process."""
-    print(f"Processing '{INPUT_FILE}' to generate audio in '{OUTPUT_DIR}'...")
+def parse_shard(value: str):
+    """Parses an 'i/N' shard spec into (i, N)."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{count - 1}, got '{value}'")
+    return index, count
+
+def metrics_file_for(shard):
+    """Each shard appends to its own metrics file so processes never share one."""
+    if shard is None:
+        return METRICS_FILE
+    stem, ext = os.path.splitext(METRICS_FILE)
+    return f"{stem}.shard{shard[0]}of{shard[1]}{ext}"
+
+async def main(input_file: str = INPUT_FILE, shard=None, local_workers: int = 1,
+               progress_fn=None, verbose: bool = True):
+    """
+    Main function to start the audio generation process.
+    With `local_workers` > 1 this is one of several processes on the same
+    machine, so the concurrency, rate and encoder budgets are split evenly.
+    """
+    if verbose:
+        print(f"Processing '{input_file}' to generate audio in '{OUTPUT_DIR}'...")
     # The main logic is now a single call to the reusable processor
-    await process_text_file_concurrently(
-        input_file=INPUT_FILE,
+    return await process_text_file_concurrently(
+        input_file=input_file,
         system_prompt=SYSTEM_PROMPT,
         line_processor_fn=process_quran_line,
-        concurrency_limit=CONCURRENCY_LIMIT
+        concurrency_limit=max(1, CONCURRENCY_LIMIT // local_workers),
+        requests_per_minute=REQUESTS_PER_MINUTE and REQUESTS_PER_MINUTE / local_workers,
+        session_pool_size=max(1, SESSION_POOL_SIZE // local_workers) if SESSION_POOL_SIZE else SESSION_POOL_SIZE,
+        output_format=OUTPUT_FORMAT,
+        encoder_workers=max(1, ENCODER_WORKERS // local_workers),
+        metrics_file=metrics_file_for(shard),
+        shard=shard,
+        progress_fn=progress_fn,
+        verbose=verbose
     )
 
+def _run_shard(input_file: str, shard, local_workers: int, progress_queue):
+    """Entry point of a supervised worker process: runs one shard quietly."""
+    def report(stats):
+        progress_queue.put((shard, stats))
+    try:
+        asyncio.run(main(input_file, shard, local_workers, report, verbose=False))
+    except KeyboardInterrupt:
+        pass  # The supervisor prints the summary
+
+def supervise(input_file: str, workers: int, host_shard=None):
+    """
+    Forks `workers` shard processes on this machine and shows their merged
+    progress and summary. With `host_shard` (i, N) this machine is host i of
+    N, and its processes take global shards i*workers .. i*workers+workers-1
+    of N*workers, so hosts and local processes never overlap.
+    """
+    host_index, host_count = host_shard or (0, 1)
+    shards = [(host_index * workers + j, host_count * workers) for j in range(workers)]
+    print(f"Processing '{input_file}' to generate audio in '{OUTPUT_DIR}' "
+          f"with {workers} worker processes (shards {shards[0][0]}-{shards[-1][0]} of {shards[0][1]})...")
+
+    started = time.time()
+    progress_queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_run_shard, args=(input_file, shard, workers, progress_queue))
+        for shard in shards
+    ]
+    for process in processes:
+        process.start()
+
+    latest = {}
+    total = count_lines(input_file) if host_count == 1 else None
+    try:
+        with tqdm(total=total, desc="Generating Audio", unit="line") as pbar:
+            while any(p.is_alive() for p in processes) or not progress_queue.empty():
+                try:
+                    shard, stats = progress_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                latest[shard] = stats
+                merged = {key: sum(s[key] for s in latest.values()) for key in stats}
+                pbar.n = merged['done']
+                pbar.set_postfix(merged, refresh=True)
+    except KeyboardInterrupt:
+        print("\nInterrupted by user. Waiting for workers to shut down...")
+    for process in processes:
+        process.join()
+
+    crashed = [shard for shard, process in zip(shards, processes) if process.exitcode not in (0, None)]
+    if crashed:
+        print(f"⚠ Worker processes for shards {crashed} exited with an error.")
+    if latest:
+        merged = {key: sum(s[key] for s in latest.values()) for key in next(iter(latest.values()))}
+        print_generation_summary(merged, CONCURRENCY_LIMIT)
+    RequestMetrics.load([metrics_file_for(shard) for shard in shards], since=started).print_summary()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate narrated audio for each line of the input file.")
+    parser.add_argument("--input", default=INPUT_FILE, help=f"Input text file (default: {INPUT_FILE}).")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N",
+                        help="Only process lines whose output path hashes into shard I of N "
+                             "(0-based), e.g. one shard per machine.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Run this many shard processes locally and merge their progress.")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        supervise(args.input, args.workers, args.shard)
+    else:
+        asyncio.run(main(args.input, args.shard))
\ No newline at end of file